@@ -169,11 +169,13 @@ class DupeGuru(Broadcaster):
         self.directories = directories.Directories()
         self.results = results.Results(self)
         self.scanner = self.SCANNER_CLASS()
+        self.scanner.digest_cache_path = op.join(self.appdata, 'cached_digests.db')
         self.options = {
             'escape_filter_regexp': True,
             'clean_empty_dirs': False,
             'ignore_hardlink_matches': False,
             'copymove_dest_type': DestType.Relative,
+            'use_folder_snapshot': False,
         }
         self.selected_dupes = []
         self.details_panel = DetailsPanel(self)
@@ -327,11 +329,11 @@ class DupeGuru(Broadcaster):
         seen_inodes = set()
         result = []
         for file in files:
-            try:
-                inode = file.path.stat().st_ino
-            except OSError:
+            # dev and inode are read along with size and mtime, which the scan needs anyway.
+            if not file.inode:
                 # The file was probably deleted or something
                 continue
+            inode = (file.dev, file.inode)
             if inode not in seen_inodes:
                 seen_inodes.add(inode)
                 result.append(file)
@@ -736,15 +738,29 @@ class DupeGuru(Broadcaster):
             if self.scanner.scan_type == scanner.ScanType.Folders:
                 files = list(self.directories.get_folders(j))
             else:
-                files = list(self.directories.get_files(j))
+                # Contents scans and hardlink removal need the stats of every file, we might as
+                # well get them from the walk.
+                read_stats = self.options['ignore_hardlink_matches'] or self.scanner.scan_type in {
+                    scanner.ScanType.Contents, scanner.ScanType.ContentsAudio
+                }
+                files = list(self.directories.get_files(
+                    j, read_stats=read_stats, size_threshold=self.scanner.size_threshold,
+                    thread_count=directories.WALK_THREAD_COUNT
+                ))
             if self.options['ignore_hardlink_matches']:
                 files = self._remove_hardlink_dupes(files)
             logging.info('Scanning %d files' % len(files))
             self.results.groups = self.scanner.get_dupe_groups(files, j)
 
+        if self.options['use_folder_snapshot']:
+            self.directories.snapshot_path = op.join(self.appdata, 'folder_snapshot.db')
+        else:
+            self.directories.snapshot_path = None
         if not self.directories.has_any_file():
             self.view.show_message(tr("The selected directories contain no scannable file."))
             return
+        # Digests of files that were deleted or changed are only purged under the scanned folders.
+        self.scanner.digest_cache_roots = list(self.directories)
         self.results.groups = []
         self._results_changed()
         self._start_job(JobType.Scan, do)
@@ -0,0 +1,495 @@
+# Copyright 2015 Hardcoded Software (http://www.hardcoded.net)
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import stat
+import time
+import logging
+import threading
+import sqlite3 as sqlite
+from collections import namedtuple
+
+from . import fs
+
+# Number of rows checked or deleted per query when purging the cache.
+PURGE_BATCH_SIZE = 1000
+# A folder listing is only reused if the folder was last modified at least that many seconds before
+# it was listed. Otherwise, it might have changed again within the resolution of its mtime.
+MTIME_RESOLUTION = 2
+
+# What SnapshotEntry.stat() returns, with the fields of os.stat_result that File._set_stats() uses.
+_SnapshotStats = namedtuple('_SnapshotStats', 'st_dev st_ino st_size st_mtime')
+
+def _to_sqlite_int(value):
+    # SQLite integers are signed 64-bit, but some filesystems use the whole unsigned range for
+    # inode numbers.
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def get_cache_key(file):
+    """Returns the ``(dev, inode, size, mtime, hash_algorithm)`` key of ``file``.
+
+    Returns ``None`` if ``file`` can't be cached. Only regular files are: the mtime of a folder
+    doesn't change when a file it contains does.
+    """
+    if not isinstance(file, fs.File) or isinstance(file, fs.Folder):
+        return None
+    if not file.inode: # the file couldn't be stat'ed
+        return None
+    return (
+        _to_sqlite_int(file.dev), _to_sqlite_int(file.inode), file.size, file.mtime,
+        file.hash_algorithm
+    )
+
+def _get_field_key(field):
+    # The sampled digest depends on the sampling parameters of core.fs, which can be changed: they
+    # are stored with it so that a digest sampled differently is never used.
+    if field == 'md5samples':
+        return '%s:%d:%d:%d:%d' % (
+            field, fs.SAMPLE_SIZE, fs.SAMPLE_SPACING, fs.MAX_SAMPLE_COUNT, fs.MIN_SAMPLED_SIZE
+        )
+    return field
+
+class DigestCache:
+    """A class to cache file digests (``md5head``, ``md5partial``, ``md5samples``, ``md5``) across
+    scans.
+
+    Digests are stored by device and inode, along with the size and mtime the file had when they
+    were computed. A digest is only used if the file still has the same size and mtime, so that a
+    modified or replaced file is read again.
+    """
+    def __init__(self, db=':memory:'):
+        self.dbname = db
+        self.con = None
+        self.hit_count = 0
+        self.miss_count = 0
+        self._create_con()
+
+    def __len__(self):
+        sql = "select count(*) from digests"
+        result = self.con.execute(sql).fetchall()
+        return result[0][0]
+
+    def _create_con(self, second_try=False):
+        def create_tables():
+            logging.debug("Creating digest cache tables.")
+            self.con.execute("drop table if exists digests")
+            self.con.execute(
+                "create table digests(dev INTEGER, inode INTEGER, algorithm TEXT, field TEXT, "
+                "size INTEGER, mtime REAL, path TEXT, digest BLOB, "
+                "primary key (dev, inode, algorithm, field))"
+            )
+
+        self.con = sqlite.connect(self.dbname, isolation_level=None)
+        try:
+            self.con.execute(
+                "select dev, inode, algorithm, field, size, mtime, path, digest from digests "
+                "where 1=2"
+            )
+        except sqlite.OperationalError: # new db
+            create_tables()
+        except sqlite.DatabaseError as e: # corrupted db
+            if second_try:
+                raise # Something really strange is happening
+            logging.warning('Could not create digest cache because of an error: %s', str(e))
+            self.con.close()
+            os.remove(self.dbname)
+            self._create_con(second_try=True)
+
+    def _delete_rowids(self, rowids):
+        for i in range(0, len(rowids), PURGE_BATCH_SIZE):
+            batch = rowids[i:i+PURGE_BATCH_SIZE]
+            sql = "delete from digests where rowid in (%s)" % ','.join(map(str, batch))
+            self.con.execute(sql)
+
+    def clear(self):
+        self.close()
+        if self.dbname != ':memory:':
+            os.remove(self.dbname)
+        self._create_con()
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+        self.con = None
+
+    def load(self, files, field):
+        """Sets ``field`` on each of ``files`` for which it's cached.
+
+        Returns a list of ``(file, key)`` for files whose ``field`` wasn't cached, with ``key``
+        being :func:`get_cache_key` of the file, to give to :meth:`save` once the digests are read.
+        Files that can't be cached aren't returned.
+        """
+        sql = "select size, mtime, digest from digests " \
+            "where dev = ? and inode = ? and algorithm = ? and field = ?"
+        field_key = _get_field_key(field)
+        missing = []
+        for file in files:
+            key = get_cache_key(file)
+            if key is None:
+                continue
+            dev, inode, size, mtime, algorithm = key
+            row = self.con.execute(sql, [dev, inode, algorithm, field_key]).fetchone()
+            if row is not None and row[0] == size and row[1] == mtime:
+                setattr(file, field, row[2])
+                self.hit_count += 1
+            else:
+                missing.append((file, key))
+                self.miss_count += 1
+        return missing
+
+    def save(self, file_keys, field):
+        """Stores ``field`` of the files in ``file_keys``, as returned by :meth:`load`.
+
+        Files for which ``field`` couldn't be read are skipped. All digests are written in a single
+        transaction.
+        """
+        rows = []
+        field_key = _get_field_key(field)
+        for file, key in file_keys:
+            digest = getattr(file, field)
+            if not digest:
+                continue
+            dev, inode, size, mtime, algorithm = key
+            rows.append((dev, inode, algorithm, field_key, size, mtime, str(file.path), digest))
+        if not rows:
+            return
+        sql = "insert or replace into digests(dev, inode, algorithm, field, size, mtime, path, " \
+            "digest) values(?, ?, ?, ?, ?, ?, ?, ?)"
+        try:
+            self.con.execute("begin")
+            self.con.executemany(sql, rows)
+            self.con.execute("commit")
+        except sqlite.DatabaseError as e:
+            logging.warning('Digest cache could not save %d digests: %s', len(rows), str(e))
+            if self.con.in_transaction:
+                self.con.execute("rollback")
+
+    def purge_outdated(self, roots=None):
+        """Go through the cache and purge outdated records.
+
+        A record is outdated if its file doesn't exist anymore or if its inode, size or mtime
+        changed. Records are checked and deleted in batches of :data:`PURGE_BATCH_SIZE`.
+
+        :param roots: if set, only records of files under these folders are checked, so that the
+                      purge costs what the scan of these folders does and records of files on
+                      other volumes, which might just be unmounted, are kept.
+        """
+        todelete = []
+        sql = "select rowid, dev, inode, size, mtime, path from digests"
+        if roots is None:
+            cur = self.con.execute(sql)
+        else:
+            # substr() rather than like, which is case insensitive and has wildcards.
+            prefixes = [os.path.join(str(root), '') for root in roots]
+            if not prefixes:
+                return
+            sql += " where " + " or ".join(["substr(path, 1, ?) = ?"] * len(prefixes))
+            cur = self.con.execute(sql, [x for p in prefixes for x in (len(p), p)])
+        while True:
+            rows = cur.fetchmany(PURGE_BATCH_SIZE)
+            if not rows:
+                break
+            for rowid, dev, inode, size, mtime, path_str in rows:
+                try:
+                    stats = os.stat(path_str)
+                except OSError:
+                    todelete.append(rowid)
+                    continue
+                current = (
+                    _to_sqlite_int(stats.st_dev), _to_sqlite_int(stats.st_ino), stats.st_size,
+                    stats.st_mtime
+                )
+                if current != (dev, inode, size, mtime):
+                    todelete.append(rowid)
+        self._delete_rowids(todelete)
+
+    def log_hit_ratio(self):
+        """Logs how many digests were found in the cache since it was opened."""
+        total = self.hit_count + self.miss_count
+        if total:
+            logging.info(
+                "Digest cache: %d hits out of %d lookups (%0.1f%%)", self.hit_count, total,
+                self.hit_count * 100 / total
+            )
+
+class SnapshotEntry:
+    """An item of a folder listing in a :class:`FolderSnapshot`.
+
+    It has the subset of the ``os.DirEntry`` interface that :func:`fs.get_files_and_folders` uses.
+    Like with ``os.DirEntry``, the item is only stat()ed when :meth:`stat` is called, unless its
+    stats were stored with the listing.
+    """
+    IS_DIR = 1
+    IS_FILE = 2
+    IS_SYMLINK = 4
+
+    __slots__ = ['name', 'path', 'kind', 'stats', '_dir_entry']
+
+    def __init__(self, name, path, kind, stats=None, dir_entry=None):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.stats = stats
+        self._dir_entry = dir_entry
+
+    @classmethod
+    def from_dir_entry(cls, entry):
+        def test(method):
+            try:
+                return method()
+            except OSError:
+                return False
+
+        kind = 0
+        if test(entry.is_dir):
+            kind |= cls.IS_DIR
+        if test(entry.is_file):
+            kind |= cls.IS_FILE
+        if test(entry.is_symlink):
+            kind |= cls.IS_SYMLINK
+        return cls(name=entry.name, path=entry.path, kind=kind, dir_entry=entry)
+
+    @classmethod
+    def from_path(cls, path):
+        # Without scandir(). ``path`` is a ``Path``.
+        kind = 0
+        try:
+            if stat.S_ISLNK(os.lstat(str(path)).st_mode):
+                kind |= cls.IS_SYMLINK
+            mode = os.stat(str(path)).st_mode
+            if stat.S_ISDIR(mode):
+                kind |= cls.IS_DIR
+            elif stat.S_ISREG(mode):
+                kind |= cls.IS_FILE
+        except OSError:
+            pass
+        return cls(name=path.name, path=str(path), kind=kind)
+
+    def is_dir(self):
+        return bool(self.kind & self.IS_DIR)
+
+    def is_file(self):
+        return bool(self.kind & self.IS_FILE)
+
+    def is_symlink(self):
+        return bool(self.kind & self.IS_SYMLINK)
+
+    def stat(self):
+        if self.stats is None:
+            if self._dir_entry is not None:
+                stats = self._dir_entry.stat()
+            else:
+                stats = os.stat(self.path)
+            self.stats = _SnapshotStats(stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime)
+        return self.stats
+
+class FolderSnapshot:
+    """A class to remember folder listings across scans.
+
+    For each folder listed through it, the snapshot stores the folder's mtime and its items, with
+    the size and mtime of the files that were stat()ed during the walk. When the folder is listed
+    again and its mtime didn't change, the stored listing is used and neither the folder nor those
+    files are read.
+
+    Adding, removing or renaming an item changes the mtime of its folder, but modifying a file in
+    place doesn't. Such a file keeps its stored size and mtime until its folder changes. Digests in
+    the :class:`DigestCache` are still checked against the actual file.
+
+    :meth:`list_folder` can be called from several threads. New listings are kept in memory until
+    :meth:`save`. After a complete walk, :meth:`purge_unvisited` drops the folders that weren't
+    listed.
+    """
+    def __init__(self, db=':memory:'):
+        self.dbname = db
+        self.con = None
+        self.hit_count = 0
+        self.miss_count = 0
+        self._lock = threading.Lock()
+        # {path_str: (mtime_ns, inode, listed_at, entries)}
+        self._listings = {}
+        # path_str of every folder listed since the snapshot was opened
+        self._visited = set()
+        self._create_con()
+
+    def __len__(self):
+        sql = "select count(*) from folders"
+        result = self.con.execute(sql).fetchall()
+        return result[0][0]
+
+    def _create_con(self, second_try=False):
+        def create_tables():
+            logging.debug("Creating folder snapshot tables.")
+            self.con.execute("drop table if exists folders")
+            self.con.execute("drop table if exists entries")
+            self.con.execute(
+                "create table folders(path TEXT primary key, mtime_ns INTEGER, inode INTEGER, "
+                "listed_at REAL)"
+            )
+            self.con.execute(
+                "create table entries(folder TEXT, name TEXT, kind INTEGER, dev INTEGER, "
+                "inode INTEGER, size INTEGER, mtime REAL)"
+            )
+            self.con.execute("create index idx_folder on entries (folder)")
+
+        # Folders are looked up from the threads of the directory walk, always under self._lock.
+        self.con = sqlite.connect(self.dbname, isolation_level=None, check_same_thread=False)
+        try:
+            self.con.execute("select path, mtime_ns, inode, listed_at from folders where 1=2")
+            self.con.execute(
+                "select folder, name, kind, dev, inode, size, mtime from entries where 1=2"
+            )
+        except sqlite.OperationalError: # new db
+            create_tables()
+        except sqlite.DatabaseError as e: # corrupted db
+            if second_try:
+                raise # Something really strange is happening
+            logging.warning('Could not create folder snapshot because of an error: %s', str(e))
+            self.con.close()
+            os.remove(self.dbname)
+            self._create_con(second_try=True)
+
+    def _get_stored_entries(self, path_str, mtime_ns, inode):
+        # Returns the stored entries of ``path_str`` if they're still up to date, or None.
+        with self._lock:
+            if self.con is None:
+                return None
+            sql = "select mtime_ns, inode, listed_at from folders where path = ?"
+            row = self.con.execute(sql, [path_str]).fetchone()
+            if row is None or row[:2] != (mtime_ns, _to_sqlite_int(inode)):
+                return None
+            if mtime_ns / 10**9 > row[2] - MTIME_RESOLUTION:
+                return None
+            sql = "select name, kind, dev, inode, size, mtime from entries where folder = ?"
+            rows = self.con.execute(sql, [path_str]).fetchall()
+        result = []
+        for name, kind, dev, inode, size, mtime in rows:
+            stats = _SnapshotStats(dev, inode, size, mtime) if size is not None else None
+            result.append(SnapshotEntry(name, os.path.join(path_str, name), kind, stats))
+        return result
+
+    def clear(self):
+        self.close()
+        if self.dbname != ':memory:':
+            os.remove(self.dbname)
+        self._create_con()
+
+    def close(self):
+        with self._lock:
+            if self.con is not None:
+                self.con.close()
+            self.con = None
+
+    def list_folder(self, path):
+        """Returns a list of :class:`SnapshotEntry` for the items in ``path``.
+
+        :param Path path: path to list
+        :raises EnvironmentError: if ``path`` can't be listed.
+        """
+        path_str = str(path)
+        listed_at = time.time()
+        stats = os.stat(path_str)
+        with self._lock:
+            self._visited.add(path_str)
+        entries = self._get_stored_entries(path_str, stats.st_mtime_ns, stats.st_ino)
+        if entries is not None:
+            with self._lock:
+                self.hit_count += 1
+            return entries
+        if fs.scandir is not None:
+            entries = [SnapshotEntry.from_dir_entry(entry) for entry in fs.scandir(path_str)]
+        else:
+            entries = [SnapshotEntry.from_path(item_path) for item_path in path.listdir()]
+        with self._lock:
+            self.miss_count += 1
+            self._listings[path_str] = (stats.st_mtime_ns, stats.st_ino, listed_at, entries)
+        return entries
+
+    def save(self):
+        """Stores the folders listed since the last save, in a single transaction."""
+        with self._lock:
+            listings = self._listings
+            self._listings = {}
+            if not listings or self.con is None:
+                return
+            folder_rows = []
+            entry_rows = []
+            for path_str, (mtime_ns, inode, listed_at, entries) in listings.items():
+                folder_rows.append((path_str, mtime_ns, _to_sqlite_int(inode), listed_at))
+                for entry in entries:
+                    stats = entry.stats
+                    if stats is not None and entry.is_file():
+                        dev, inode, size, mtime = stats
+                        stats_row = (_to_sqlite_int(dev), _to_sqlite_int(inode), size, mtime)
+                    else:
+                        stats_row = (None, None, None, None)
+                    entry_rows.append((path_str, entry.name, entry.kind) + stats_row)
+            try:
+                self.con.execute("begin")
+                self.con.executemany(
+                    "delete from entries where folder = ?", [(row[0], ) for row in folder_rows]
+                )
+                self.con.executemany(
+                    "insert or replace into folders(path, mtime_ns, inode, listed_at) "
+                    "values(?, ?, ?, ?)", folder_rows
+                )
+                self.con.executemany(
+                    "insert into entries(folder, name, kind, dev, inode, size, mtime) "
+                    "values(?, ?, ?, ?, ?, ?, ?)", entry_rows
+                )
+                self.con.execute("commit")
+            except sqlite.DatabaseError as e:
+                logging.warning(
+                    'Folder snapshot could not save %d folders: %s', len(folder_rows), str(e)
+                )
+                if self.con.in_transaction:
+                    self.con.execute("rollback")
+
+    def purge_unvisited(self, roots):
+        """Deletes the stored folders under ``roots`` that weren't listed since the snapshot was
+        opened.
+
+        Only call it after a complete walk of ``roots``: the folders it didn't list were deleted or
+        aren't scanned anymore.
+        """
+        with self._lock:
+            if self.con is None:
+                return
+            # substr() rather than like, which is case insensitive and has wildcards.
+            conditions = []
+            args = []
+            for root in roots:
+                prefix = os.path.join(str(root), '')
+                conditions.append("path = ? or substr(path, 1, ?) = ?")
+                args += [str(root), len(prefix), prefix]
+            if not conditions:
+                return
+            sql = "select path from folders where " + " or ".join(conditions)
+            todelete = [
+                (path_str, ) for path_str, in self.con.execute(sql, args)
+                if path_str not in self._visited
+            ]
+            if not todelete:
+                return
+            try:
+                self.con.execute("begin")
+                self.con.executemany("delete from entries where folder = ?", todelete)
+                self.con.executemany("delete from folders where path = ?", todelete)
+                self.con.execute("commit")
+            except sqlite.DatabaseError as e:
+                logging.warning(
+                    'Folder snapshot could not purge %d folders: %s', len(todelete), str(e)
+                )
+                if self.con.in_transaction:
+                    self.con.execute("rollback")
+
+    def log_hit_ratio(self):
+        """Logs how many folder listings were found in the snapshot since it was opened."""
+        total = self.hit_count + self.miss_count
+        if total:
+            logging.info(
+                "Folder snapshot: %d hits out of %d folders (%0.1f%%)", self.hit_count, total,
+                self.hit_count * 100 / total
+            )
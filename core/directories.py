@@ -7,13 +7,18 @@
 # http://www.gnu.org/licenses/gpl-3.0.html
 
 from xml.etree import ElementTree as ET
+import os.path as op
 import logging
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from hscommon.jobprogress import job
 from hscommon.path import Path
 from hscommon.util import FileOrPath
 
 from . import fs
+from .cache import FolderSnapshot
 
 __all__ = [
     'Directories',
@@ -22,6 +27,14 @@ __all__ = [
     'InvalidPathError',
 ]
 
+# Number of threads listing folders ahead of get_files() during a scan. Listing is mostly waiting
+# on the filesystem, which matters the most on network shares.
+WALK_THREAD_COUNT = 8
+# Maximum number of folders listed, or being listed, ahead of where get_files() is.
+WALK_LOOKAHEAD = 64
+# Seconds get_files() waits on a folder listing before checking whether the job was cancelled.
+WALK_WAIT_INTERVAL = 0.1
+
 class DirectoryState:
     """Enum describing how a folder should be considered.
 
@@ -39,6 +52,140 @@ class AlreadyThereError(Exception):
 class InvalidPathError(Exception):
     """The path being added is invalid"""
 
+class _StateTree:
+    # Explicit folder states, held in a tree of path components so that finding the state of a
+    # folder, or whether any folder under it has a state, doesn't need to go through all states.
+    __slots__ = ['children', 'state', 'included_count']
+
+    def __init__(self):
+        # {path component: _StateTree}
+        self.children = {}
+        # The explicit state of this folder, if any
+        self.state = None
+        # The number of folders under this one with an explicit state that isn't Excluded
+        self.included_count = 0
+
+    def _add_included_count(self, path, delta):
+        node = self
+        for name in path:
+            node.included_count += delta
+            node = node.children[name]
+
+    def find(self, path):
+        node = self
+        for name in path:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def items(self, path=()):
+        if self.state is not None:
+            yield Path(path), self.state
+        for name, child in self.children.items():
+            yield from child.items(path + (name, ))
+
+    def remove_below(self, path):
+        # Removes the states of all folders under ``path``.
+        node = self.find(path)
+        if node is None:
+            return
+        self._add_included_count(path, -node.included_count)
+        node.children = {}
+        node.included_count = 0
+
+    def set(self, path, state):
+        node = self
+        for name in path:
+            node = node.children.setdefault(name, _StateTree())
+        was_included = node.state is not None and node.state != DirectoryState.Excluded
+        node.state = state
+        is_included = state != DirectoryState.Excluded
+        if is_included != was_included:
+            self._add_included_count(path, 1 if is_included else -1)
+
+class _FolderReader:
+    # Lists the folders of one get_files() walk ahead of it, in threads.
+    #
+    # The walk goes depth first, so folders are listed in that order: each folder has a key made
+    # of its index in the listing of each of its parents, and pending folders are submitted by
+    # smallest key first. Subfolders are queued by the thread that listed their parent. At most
+    # ``lookahead`` folders are submitted and not yet taken by the walk at a time.
+    def __init__(self, list_folder, roots, thread_count, lookahead):
+        self._list_folder = list_folder
+        self._lookahead = lookahead
+        self._executor = ThreadPoolExecutor(thread_count)
+        # Everything below is protected by the lock. Nothing is submitted once closed.
+        self._lock = threading.Lock()
+        self._closed = False
+        self._keys = {}
+        self._pending = [] # heap of (key, path)
+        self._futures = {}
+        with self._lock:
+            self._queue(roots, ())
+            self._submit_pending()
+
+    def _queue(self, paths, parent_key):
+        for index, path in enumerate(paths):
+            key = parent_key + (index,)
+            self._keys[path] = key
+            heapq.heappush(self._pending, (key, path))
+
+    def _submit_pending(self):
+        while self._pending and len(self._futures) < self._lookahead and not self._closed:
+            key, path = heapq.heappop(self._pending)
+            self._futures[path] = self._executor.submit(self._read, path)
+
+    def _read(self, path):
+        listing = self._list_folder(path)
+        if listing is not None:
+            with self._lock:
+                if not self._closed:
+                    self._queue(listing[1], self._keys[path])
+                    self._submit_pending()
+        return listing
+
+    def get(self, path, j):
+        # Returns ``_list_folder(path)``, waiting for it if it's not listed yet.
+        with self._lock:
+            if path not in self._keys:
+                # A root that wasn't given to the reader. It's listed right away, and its subfolders
+                # come before the pending folders of the roots the walk is done with.
+                self._keys[path] = (-1, len(self._keys))
+                future = self._executor.submit(self._read, path)
+            else:
+                future = self._futures.pop(path, None)
+                if future is None:
+                    future = self._take_pending(path)
+            self._submit_pending()
+        while True:
+            j.check_if_cancelled()
+            try:
+                return future.result(timeout=WALK_WAIT_INTERVAL)
+            except FutureTimeoutError:
+                pass
+
+    def _take_pending(self, path):
+        # Not submitted yet because the look-ahead is full. It's the next folder of the walk, so
+        # it's usually the first pending one.
+        entry = (self._keys[path], path)
+        if self._pending[0] == entry:
+            heapq.heappop(self._pending)
+        else:
+            self._pending.remove(entry)
+            heapq.heapify(self._pending)
+        return self._executor.submit(self._read, path)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            futures = list(self._futures.values())
+            self._futures = {}
+            self._pending = []
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
 class Directories:
     """Holds user folder selection.
 
@@ -51,10 +198,20 @@ class Directories:
     #---Override
     def __init__(self, fileclasses=[fs.File]):
         self._dirs = []
-        # {path: state}
-        self.states = {}
+        self._state_tree = _StateTree()
         self.fileclasses = fileclasses
         self.folderclass = fs.Folder
+        # If set, get_files() lists folders through a FolderSnapshot stored there, and folders that
+        # didn't change since the last walk aren't read again.
+        self.snapshot_path = None
+        # Walk options of the get_files() call in progress (see fs.get_files_and_folders()).
+        self._read_stats = False
+        self._size_threshold = 0
+        self._snapshot = None
+        self._reader = None
+        # During a walk, {path: state} and {path: _StateTree or None} of the folders it went through.
+        self._state_cache = None
+        self._state_node_cache = None
 
     def __contains__(self, path):
         for p in self._dirs:
@@ -77,27 +234,63 @@ class Directories:
         if path.name.startswith('.'): # hidden
             return DirectoryState.Excluded
 
-    def _get_files(self, from_path, j):
-        j.check_if_cancelled()
-        state = self.get_state(from_path)
+    def _clear_state_cache(self, walking):
+        self._state_cache = {} if walking else None
+        self._state_node_cache = {} if walking else None
+
+    def _get_state_node(self, path):
+        # Returns the node of ``path`` in the state tree, or None if neither it nor any folder under
+        # it has a state. During a walk, the node is found from the one of the parent.
+        cache = self._state_node_cache
+        if cache is None or not path:
+            return self._state_tree.find(path)
+        try:
+            return cache[path]
+        except KeyError:
+            pass
+        parent_node = self._get_state_node(path.parent())
+        node = parent_node.children.get(path[-1]) if parent_node is not None else None
+        cache[path] = node
+        return node
+
+    def _is_pruned(self, path, state):
         if state == DirectoryState.Excluded:
             # Recursively get files from folders with lots of subfolder is expensive. However, there
-            # might be a subfolder in this path that is not excluded. What we want to do is to skim
-            # through self.states and see if we must continue, or we can stop right here to save time
-            if not any(p[:len(from_path)] == from_path for p in self.states):
-                return
+            # might be a subfolder in this path that is not excluded. What we want to do is to check
+            # the state tree to see if we must continue, or we can stop right here to save time
+            node = self._get_state_node(path)
+            return node is None or not node.included_count
+        return False
+
+    def _list_folder(self, path):
+        # Returns ``(files, subfolders)`` of ``path``, or None if the walk doesn't go into it. The
+        # folder is listed once. It's possible that a folder (bundle) gets into the file list. In
+        # that case, it's not in subfolders and we don't recurse into it.
+        state = self.get_state(path)
+        if self._is_pruned(path, state):
+            return None
+        fileclasses = self.fileclasses if state != DirectoryState.Excluded else []
+        return fs.get_files_and_folders(
+            path, fileclasses=fileclasses, read_stats=self._read_stats,
+            size_threshold=self._size_threshold, snapshot=self._snapshot
+        )
+
+    def _get_files(self, from_path, j):
+        j.check_if_cancelled()
         try:
-            filepaths = set()
+            if self._reader is not None:
+                listing = self._reader.get(from_path, j)
+            else:
+                listing = self._list_folder(from_path)
+            if listing is None:
+                return
+            found_files, subfolders = listing
+            state = self.get_state(from_path)
             if state != DirectoryState.Excluded:
-                found_files = fs.get_files(from_path, fileclasses=self.fileclasses)
                 logging.debug("Collected %d files in folder %s", len(found_files), str(from_path))
                 for file in found_files:
                     file.is_ref = state == DirectoryState.Reference
-                    filepaths.add(file.path)
                     yield file
-            # it's possible that a folder (bundle) gets into the file list. in that case, we don't
-            # want to recurse into it
-            subfolders = [p for p in from_path.listdir() if not p.islink() and p.isdir() and p not in filepaths]
             for subfolder in subfolders:
                 for file in self._get_files(subfolder, j):
                     yield file
@@ -150,40 +343,87 @@ class Directories:
         except EnvironmentError:
             return []
 
-    def get_files(self, j=job.nulljob):
+    def get_files(self, j=job.nulljob, read_stats=False, size_threshold=0, thread_count=1):
         """Returns a list of all files that are not excluded.
 
         Returned files also have their ``is_ref`` attr set if applicable.
+
+        :param bool read_stats: if true, files get their size, mtime and inode from the directory
+                                walk, which saves a ``stat()`` call for each when the scan needs
+                                them.
+        :param int size_threshold: if set, files smaller than that are skipped during the walk.
+        :param int thread_count: if more than 1, folders of all roots are listed ahead in that many
+                                 threads. Files are still returned in the same order as without
+                                 threads.
         """
-        for path in self._dirs:
-            for file in self._get_files(path, j):
-                yield file
+        self._read_stats = read_stats
+        self._size_threshold = size_threshold
+        self._clear_state_cache(True)
+        if self.snapshot_path:
+            self._snapshot = FolderSnapshot(self.snapshot_path)
+        if thread_count > 1:
+            # Subclasses can have virtual roots that their _get_files() handles. Only folders that
+            # are actually on the filesystem are listed ahead.
+            roots = [path for path in self._dirs if op.isabs(str(path)) and path.isdir()]
+            self._reader = _FolderReader(self._list_folder, roots, thread_count, WALK_LOOKAHEAD)
+        try:
+            for path in self._dirs:
+                for file in self._get_files(path, j):
+                    yield file
+            if self._snapshot is not None:
+                # The walk is complete, folders it didn't go through are gone or aren't scanned.
+                self._snapshot.purge_unvisited(self._dirs)
+        finally:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            if self._snapshot is not None:
+                self._snapshot.save()
+                self._snapshot.log_hit_ratio()
+                self._snapshot.close()
+                self._snapshot = None
+            self._clear_state_cache(False)
+            self._read_stats = False
+            self._size_threshold = 0
 
     def get_folders(self, j=job.nulljob):
         """Returns a list of all folders that are not excluded.
 
         Returned folders also have their ``is_ref`` attr set if applicable.
         """
-        for path in self._dirs:
-            from_folder = self.folderclass(path)
-            for folder in self._get_folders(from_folder, j):
-                yield folder
+        self._clear_state_cache(True)
+        try:
+            for path in self._dirs:
+                from_folder = self.folderclass(path)
+                for folder in self._get_folders(from_folder, j):
+                    yield folder
+        finally:
+            self._clear_state_cache(False)
 
     def get_state(self, path):
         """Returns the state of ``path``.
 
         :rtype: :class:`DirectoryState`
         """
-        if path in self.states:
-            return self.states[path]
-        default_state = self._default_state_for_path(path)
-        if default_state is not None:
-            return default_state
-        parent = path.parent()
-        if parent in self:
-            return self.get_state(parent)
-        else:
-            return DirectoryState.Normal
+        cache = self._state_cache
+        if cache is not None:
+            try:
+                return cache[path]
+            except KeyError:
+                pass
+        node = self._get_state_node(path)
+        state = node.state if node is not None else None
+        if state is None:
+            state = self._default_state_for_path(path)
+        if state is None:
+            parent = path.parent()
+            if parent in self:
+                state = self.get_state(parent)
+            else:
+                state = DirectoryState.Normal
+        if cache is not None:
+            cache[path] = state
+        return state
 
     def has_any_file(self):
         """Returns whether selected folders contain any file.
@@ -222,7 +462,7 @@ class Directories:
                 continue
             path = attrib['path']
             state = attrib['value']
-            self.states[Path(path)] = int(state)
+            self._state_tree.set(Path(path), int(state))
 
     def save_to_file(self, outfile):
         """Save folder selection as XML to ``outfile``.
@@ -250,8 +490,16 @@ class Directories:
         """
         if self.get_state(path) == state:
             return
-        for iter_path in list(self.states.keys()):
-            if path.is_parent_of(iter_path):
-                del self.states[iter_path]
-        self.states[path] = state
+        self._state_tree.remove_below(path)
+        self._state_tree.set(path, state)
+        if self._state_cache is not None:
+            self._clear_state_cache(True)
+
+    #---Properties
+    @property
+    def states(self):
+        """``{path: state}`` of folders that have an explicit state.
 
+        This is a copy: states are changed through :meth:`set_state`.
+        """
+        return dict(self._state_tree.items())
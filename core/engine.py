@@ -6,17 +6,26 @@
 # which should be included with this package. The terms are also available at
 # http://www.gnu.org/licenses/gpl-3.0.html
 
+import bisect
 import difflib
+import hashlib
+import heapq
 import itertools
 import logging
+import multiprocessing
 import string
-from collections import defaultdict, namedtuple
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter, defaultdict, namedtuple
+from functools import lru_cache
 from unicodedata import normalize
 
-from hscommon.util import flatten, multi_replace
+from hscommon.util import flatten
 from hscommon.trans import tr
 from hscommon.jobprogress import job
 
+from .cache import DigestCache
+
 (
     WEIGHT_WORDS,
     MATCH_SIMILAR_WORDS,
@@ -24,13 +33,83 @@ from hscommon.jobprogress import job
 ) = range(3)
 
 JOB_REFRESH_RATE = 100
+# Many names repeat across folders ("IMG_0001.JPG", "track 01"), so we remember the words of that
+# many names.
+WORDS_CACHE_SIZE = 50000
+# Default LSH parameters for approximate matching (see getmatches()). With 20 bands of 4 rows, pairs
+# of word sets with a Jaccard index of 2/3 (which is a 80% match) are found ~99% of the time, pairs
+# with an index of 1/2 (67%), ~73% of the time. More bands raise recall, more rows lower it.
+LSH_BANDS = 20
+LSH_ROWS = 4
+try:
+    PROCESS_COUNT = multiprocessing.cpu_count()
+except NotImplementedError:
+    PROCESS_COUNT = 1
+# Below that many objects to match, starting processes costs more than what it saves.
+MIN_OBJECTS_FOR_PROCESSES = 5000
+# Each process gets that many tasks, so that processes that get the easy ones don't wait for the
+# others.
+TASKS_PER_PROCESS = 16
+# Contents scans read digests in that many threads by default (see itermatches_by_contents()).
+# hashlib releases the GIL, so threads let us keep more than one read in flight.
+HASH_THREAD_COUNT = 4
+# Number of digest reads queued per thread at a time. Files are submitted as reads complete, so
+# that there's never one pending read per file of the stage.
+PENDING_READS_PER_THREAD = 4
+# Bytewise contents comparison reads files that many bytes at a time, and keeps one block per
+# compared file in memory. Bigger buckets are hashed instead, to bound memory and open files.
+COMPARE_BLOCK_SIZE = 1024 * 1024
+COMPARE_MAX_FILE_COUNT = 32
+
+class _WordCharTable(dict):
+    # Translation table used by getwords(). Word separators become spaces, ASCII letters are
+    # lowercased and every other char that isn't an ASCII digit or whitespace is removed. We can't
+    # list every non-ASCII char in advance, so they're added as we meet them.
+    def __missing__(self, char):
+        self[char] = None
+        return None
+
+def _build_word_char_table(separators):
+    result = _WordCharTable.fromkeys(range(128))
+    for c in string.ascii_letters + string.digits + string.whitespace:
+        result[ord(c)] = c.lower()
+    for c in separators:
+        result[ord(c)] = ' '
+    return result
 
-def getwords(s):
+
+WORD_CHARS = _build_word_char_table("-_&+():;\\[]{}.,<>/?~!@#$*")
+# getwords_multiple() works on all strings at once, separated with a NUL char that has to survive
+# the translation.
+MULTIPLE_WORD_CHARS = _WordCharTable(WORD_CHARS)
+MULTIPLE_WORD_CHARS[0] = '\0'
+
+@lru_cache(maxsize=WORDS_CACHE_SIZE)
+def _getwords(s):
     # We decompose the string so that ascii letters with accents can be part of the word.
-    s = normalize('NFD', s)
-    s = multi_replace(s, "-_&+():;\\[]{}.,<>/?~!@#$*", ' ').lower()
-    s = ''.join(c for c in s if c in string.ascii_letters + string.digits + string.whitespace)
-    return [_f for _f in s.split(' ') if _f] # remove empty elements
+    s = normalize('NFD', s).translate(WORD_CHARS)
+    return tuple(word for word in s.split(' ') if word) # remove empty elements
+
+def getwords(s):
+    return list(_getwords(s))
+
+def getwords_multiple(strings):
+    """Returns a list with the result of :func:`getwords` for each string in ``strings``.
+
+    All distinct strings are normalized and translated in one go, which is faster than calling
+    :func:`getwords` for each of them.
+    """
+    unique = list(dict.fromkeys(strings))
+    if not unique:
+        return []
+    s = '\0'.join(unique)
+    if s.count('\0') != len(unique) - 1:
+        # We can't use our separator if it's in one of our strings.
+        return [getwords(item) for item in strings]
+    s = normalize('NFD', s).translate(MULTIPLE_WORD_CHARS)
+    parts = (part.split(' ') for part in s.split('\0'))
+    string2words = {item: [word for word in words if word] for item, words in zip(unique, parts)}
+    return [list(string2words[item]) for item in strings]
 
 def getfields(s):
     fields = [getwords(field) for field in s.split(' - ')]
@@ -45,55 +124,203 @@ def unpack_fields(fields):
             result.append(field)
     return result
 
-def compare(first, second, flags=()):
-    """Returns the % of words that match between ``first`` and ``second``
-
-    The result is a ``int`` in the range 0..100.
-    ``first`` and ``second`` can be either a string or a list (of words).
-    """
-    if not (first and second):
-        return 0
-    if any(isinstance(element, list) for element in first):
-        return compare_fields(first, second, flags)
-    second = second[:] #We must use a copy of second because we remove items from it
-    match_similar = MATCH_SIMILAR_WORDS in flags
-    weight_words = WEIGHT_WORDS in flags
-    joined = first + second
-    total_count = (sum(len(word) for word in joined) if weight_words else len(joined))
-    match_count = 0
-    in_order = True
+def _is_in_order(first, second):
+    # Applies the same rule as the word by word matching of similar words: every word of ``first``
+    # that matches has to be the first word of ``second`` that hasn't been matched yet.
+    second = list(second)
     for word in first:
-        if match_similar and (word not in second):
-            similar = difflib.get_close_matches(word, second, 1, 0.8)
-            if similar:
-                word = similar[0]
         if word in second:
             if second[0] != word:
-                in_order = False
+                return False
             second.remove(word)
-            match_count += (len(word) if weight_words else 1)
+    return True
+
+def _compare_words(first, second, flags, get_weight, get_similar):
+    # ``first`` and ``second`` are sequences of hashable words (strings or interned IDs).
+    # ``get_weight(word)`` returns the weight of a word when WEIGHT_WORDS is set and
+    # ``get_similar(word, words)`` returns the word of ``words`` that is similar to ``word`` (or
+    # None) when MATCH_SIMILAR_WORDS is set.
+    weight_words = WEIGHT_WORDS in flags
+    if weight_words:
+        total_count = sum(map(get_weight, first)) + sum(map(get_weight, second))
+    else:
+        total_count = len(first) + len(second)
+    in_order = None
+    if MATCH_SIMILAR_WORDS in flags:
+        # Which word is similar depends on which words of second haven't been matched yet, so we
+        # have to match words one by one.
+        second = list(second)
+        match_count = 0
+        in_order = True
+        for word in first:
+            if word not in second:
+                similar = get_similar(word, second)
+                if similar is not None:
+                    word = similar
+            if word in second:
+                if second[0] != word:
+                    in_order = False
+                second.remove(word)
+                match_count += (get_weight(word) if weight_words else 1)
+    else:
+        # Matching words is a multiset intersection. When one of the two sides has no duplicate
+        # words, it's a plain set intersection, which is much cheaper than a Counter intersection.
+        first_set = set(first)
+        if len(first_set) == len(first):
+            common = first_set.intersection(second)
+        else:
+            second_set = set(second)
+            if len(second_set) == len(second):
+                common = second_set.intersection(first)
+            else:
+                common = None
+        if common is not None:
+            match_count = sum(map(get_weight, common)) if weight_words else len(common)
+        else:
+            common = Counter(first) & Counter(second)
+            if weight_words:
+                match_count = sum(get_weight(word) * count for word, count in common.items())
+            else:
+                match_count = sum(common.values())
     result = round(((match_count * 2) / total_count) * 100)
-    if (result == 100) and (not in_order):
-        result = 99 # We cannot consider a match exact unless the ordering is the same
+    if result == 100:
+        if in_order is None:
+            in_order = _is_in_order(first, second)
+        if not in_order:
+            result = 99 # We cannot consider a match exact unless the ordering is the same
     return result
 
-def compare_fields(first, second, flags=()):
-    """Returns the score for the lowest matching :ref:`fields`.
 
-    ``first`` and ``second`` must be lists of lists of string. Each sub-list is then compared with
-    :func:`compare`.
+# Ratio (see difflib.SequenceMatcher.ratio()) from which two words are similar.
+SIMILAR_WORD_RATIO = 0.8
+
+def _get_close_match(word, words):
+    similar = difflib.get_close_matches(word, words, 1, SIMILAR_WORD_RATIO)
+    return similar[0] if similar else None
+
+def _get_lcs_length(char_masks, length, word):
+    # Returns the length of the longest common subsequence between ``word`` and the word of
+    # ``length`` chars for which ``char_masks`` maps each char to the bit mask of its positions.
+    # This is the bit-parallel algorithm from Crochemore et al., "A fast and practical bit-vector
+    # algorithm for the longest common subsequence problem".
+    full = (1 << length) - 1
+    v = full
+    for char in word:
+        u = v & char_masks.get(char, 0)
+        v = ((v + u) | (v - u)) & full
+    return length - bin(v).count('1')
+
+class SimilarWordIndex:
+    """Finds similar words the same way ``difflib.get_close_matches()`` does, but without computing
+    a similarity ratio with every word.
+
+    Words are kept in `BK-trees <https://en.wikipedia.org/wiki/BK-tree>`_ (one per word length)
+    under the LCS distance, which is the number of chars to remove from both words to make them
+    equal. A ratio of at least ``cutoff`` between words of a total length T means that this distance
+    is at most ``(1 - cutoff) * T``, so only the words within that distance have their ratio
+    computed.
     """
+    def __init__(self, words=()):
+        self._words = set()
+        self._trees = {}
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self._words)
+
+    def __contains__(self, word):
+        return word in self._words
+
+    def add(self, word):
+        """Adds ``word`` to the index.
+        """
+        if word in self._words:
+            return
+        self._words.add(word)
+        length = len(word)
+        node = self._trees.get(length)
+        if node is None:
+            self._trees[length] = (word, {})
+            return
+        char_masks = self._get_char_masks(word)
+        while True:
+            node_word, children = node
+            distance = 2 * (length - _get_lcs_length(char_masks, length, node_word))
+            if distance not in children:
+                children[distance] = (word, {})
+                return
+            node = children[distance]
+
+    @staticmethod
+    def _get_char_masks(word):
+        result = {}
+        for index, char in enumerate(word):
+            result[char] = result.get(char, 0) | (1 << index)
+        return result
+
+    def _get_candidates(self, word, cutoff):
+        # Yields the indexed words that are close enough to ``word`` to have a ratio of at least
+        # ``cutoff`` with it.
+        length = len(word)
+        char_masks = self._get_char_masks(word)
+        for other_length, root in self._trees.items():
+            # The distance can't be more than that, and it's at least the difference in length.
+            max_distance = int((1 - cutoff) * (length + other_length) + 1e-9)
+            if abs(length - other_length) > max_distance:
+                continue
+            stack = [root]
+            while stack:
+                node_word, children = stack.pop()
+                lcs_length = _get_lcs_length(char_masks, length, node_word)
+                distance = length + other_length - 2 * lcs_length
+                if distance <= max_distance:
+                    yield node_word
+                # Words under a child are at child_distance from node_word and thus, by the
+                # triangle inequality, at least at abs(distance - child_distance) from word.
+                for child_distance, child in children.items():
+                    if abs(distance - child_distance) <= max_distance:
+                        stack.append(child)
+
+    def get_ratios(self, word, cutoff=0.6, possibilities=None):
+        """Returns a dict of the indexed words with a ratio of at least ``cutoff`` with ``word``.
+
+        Ratios are computed exactly like ``difflib.get_close_matches()`` does. If
+        ``possibilities`` is not None, only the words it contains are returned.
+        """
+        s = difflib.SequenceMatcher()
+        s.set_seq2(word)
+        result = {}
+        for x in self._get_candidates(word, cutoff):
+            if possibilities is not None and x not in possibilities:
+                continue
+            s.set_seq1(x)
+            if s.real_quick_ratio() >= cutoff and s.quick_ratio() >= cutoff and s.ratio() >= cutoff:
+                result[x] = s.ratio()
+        return result
+
+    def get_close_matches(self, word, n=3, cutoff=0.6, possibilities=None):
+        """Same as ``difflib.get_close_matches(word, possibilities, n, cutoff)``.
+
+        ``possibilities`` defaults to all indexed words. Otherwise, it has to be a container of
+        indexed words.
+        """
+        ratios = self.get_ratios(word, cutoff, possibilities)
+        result = heapq.nlargest(n, ((ratio, x) for x, ratio in ratios.items()))
+        return [x for ratio, x in result]
+
+def _compare_fields(first, second, flags, compare_func):
     if len(first) != len(second):
         return 0
     if NO_FIELD_ORDER in flags:
         results = []
         #We don't want to remove field directly in the list. We must work on a copy.
-        second = second[:]
+        second = list(second)
         for field1 in first:
             max = 0
             matched_field = None
             for field2 in second:
-                r = compare(field1, field2, flags)
+                r = compare_func(field1, field2, flags)
                 if r > max:
                     max = r
                     matched_field = field2
@@ -101,9 +328,111 @@ def compare_fields(first, second, flags=()):
             if matched_field:
                 second.remove(matched_field)
     else:
-        results = [compare(field1, field2, flags) for field1, field2 in zip(first, second)]
+        results = [compare_func(field1, field2, flags) for field1, field2 in zip(first, second)]
     return min(results) if results else 0
 
+def compare(first, second, flags=()):
+    """Returns the % of words that match between ``first`` and ``second``
+
+    The result is a ``int`` in the range 0..100.
+    ``first`` and ``second`` can be either a string or a list (of words).
+    """
+    if not (first and second):
+        return 0
+    if any(isinstance(element, list) for element in first):
+        return compare_fields(first, second, flags)
+    return _compare_words(first, second, flags, len, _get_close_match)
+
+def compare_fields(first, second, flags=()):
+    """Returns the score for the lowest matching :ref:`fields`.
+
+    ``first`` and ``second`` must be lists of lists of string. Each sub-list is then compared with
+    :func:`compare`.
+    """
+    return _compare_fields(first, second, flags, compare)
+
+class Vocabulary:
+    """Maps words to compact integer IDs.
+
+    Words are interned once per scan with :meth:`intern_words` and then :meth:`compare` works on
+    tuples of IDs rather than on lists of strings. Comparing ints is cheaper than comparing strings
+    and a tuple of shared ints takes much less memory than a list of strings for each file.
+
+    .. attribute:: words
+
+        List of interned words, indexed by their ID.
+    """
+    def __init__(self, words=()):
+        self._word2id = {}
+        self.words = []
+        self._lengths = []
+        self._similar_word_index = None
+        self._similar_words = {}
+        for word in words:
+            self.intern(word)
+
+    def intern(self, word):
+        """Returns the ID of ``word``, assigning it a new one if it's a new word.
+        """
+        try:
+            return self._word2id[word]
+        except KeyError:
+            result = len(self.words)
+            self._word2id[word] = result
+            self.words.append(word)
+            self._lengths.append(len(word))
+            if self._similar_words:
+                self._similar_words = {} # the new word can be similar to any of them
+            return result
+
+    def intern_words(self, words):
+        """Returns ``words`` as a tuple of IDs.
+
+        ``words`` can also be :ref:`fields`, in which case the result is a tuple of tuples of IDs.
+        """
+        intern = self.intern
+        if any(isinstance(element, list) for element in words):
+            return tuple(tuple(intern(word) for word in field) for field in words)
+        return tuple(intern(word) for word in words)
+
+    def get_length(self, word):
+        """Returns the length of the word with ID ``word``.
+        """
+        return self._lengths[word]
+
+    @property
+    def similar_word_index(self):
+        """:class:`SimilarWordIndex` of the interned words.
+        """
+        index = self._similar_word_index
+        if index is None:
+            index = self._similar_word_index = SimilarWordIndex()
+        if len(index) < len(self.words):
+            for word in self.words[len(index):]:
+                index.add(word)
+        return index
+
+    def _get_close_match(self, word, words):
+        # Same as _get_close_match() on the strings. The similar words of each word are looked up
+        # in the index once and kept for next pairs.
+        similar = self._similar_words.get(word)
+        if similar is None:
+            ratios = self.similar_word_index.get_ratios(self.words[word], SIMILAR_WORD_RATIO)
+            similar = {self._word2id[x]: (ratio, x) for x, ratio in ratios.items()}
+            self._similar_words[word] = similar
+        matches = [similar[w] for w in words if w in similar]
+        return self._word2id[max(matches)[1]] if matches else None
+
+    def compare(self, first, second, flags=()):
+        """Same as :func:`compare`, but with ``first`` and ``second`` interned by this vocabulary.
+        """
+        if not (first and second):
+            return 0
+        if isinstance(first[0], tuple):
+            return _compare_fields(first, second, flags, self.compare)
+        return _compare_words(first, second, flags, self._lengths.__getitem__, self._get_close_match)
+
+
 def build_word_dict(objects, j=job.nulljob):
     """Returns a dict of objects mapped by their words.
 
@@ -118,25 +447,31 @@ def build_word_dict(objects, j=job.nulljob):
             result[word].add(object)
     return result
 
-def merge_similar_words(word_dict):
+def merge_similar_words(word_dict, index=None):
     """Take all keys in ``word_dict`` that are similar, and merge them together.
 
     ``word_dict`` has been built with :func:`build_word_dict`. Similarity is computed with Python's
     ``difflib.get_close_matches()``, which computes the number of edits that are necessary to make
-    a word equal to the other.
+    a word equal to the other. Similar words are looked up in ``index``, a
+    :class:`SimilarWordIndex` containing (at least) all keys, which is created if not supplied.
     """
+    if index is None:
+        index = SimilarWordIndex(word_dict)
     keys = list(word_dict.keys())
     keys.sort(key=len)# we want the shortest word to stay
-    while keys:
-        key = keys.pop(0)
-        similars = difflib.get_close_matches(key, keys, 100, 0.8)
+    remaining = set(keys)
+    for key in keys:
+        if key not in remaining:
+            continue
+        remaining.remove(key)
+        similars = index.get_close_matches(key, 100, SIMILAR_WORD_RATIO, remaining)
         if not similars:
             continue
         objects = word_dict[key]
         for similar in similars:
             objects |= word_dict[similar]
             del word_dict[similar]
-            keys.remove(similar)
+            remaining.remove(similar)
 
 def reduce_common_words(word_dict, threshold):
     """Remove all objects from ``word_dict`` values where the object count >= ``threshold``
@@ -159,6 +494,333 @@ def reduce_common_words(word_dict, threshold):
         else:
             del word_dict[word]
 
+def _get_prefix_words(words, sort_key, get_weight, min_match_percentage):
+    # Returns the words of the shortest "prefix" of ``words`` (sorted with ``sort_key``) that leaves
+    # out too little weight for another word list to reach ``min_match_percentage`` with the words
+    # left out only. Two word lists sorted with the same key can't match enough if the prefixes of
+    # both don't have a word in common.
+    # A match of at least P% means that round(200 * matched / total) >= P, which requires that
+    # matched >= (P - 0.5) * total / 200. Because the other word list has to contain what's
+    # matched, this means that what's left out of the prefix has to weigh less than
+    # (2P - 1) * weight / (401 - 2P).
+    words = sorted(words, key=sort_key)
+    threshold = (2 * min_match_percentage - 1) * sum(map(get_weight, words))
+    factor = 401 - 2 * min_match_percentage
+    left_out = 0
+    index = len(words)
+    while index:
+        left_out += get_weight(words[index - 1])
+        if left_out * factor >= threshold:
+            break
+        index -= 1
+    return tuple(set(words[:index]))
+
+def _iter_bucket_matches(word_dict, word_ids, vocabulary, match_flags, min_match_percentage, j):
+    # Compares all objects that share a bucket of ``word_dict``, each pair once.
+    # To know which pairs have already been compared, objects get an index and each pair is
+    # kept under its lowest index in a sorted array of indexes. We only have to keep pairs of objects
+    # that share buckets we haven't compared yet, and an object's array is dropped as soon as all
+    # its buckets are done.
+    object2index = {o: index for index, o in enumerate(word_ids)}
+    bucket_counts = [0] * len(object2index)
+    for objects in word_dict.values():
+        for o in objects:
+            bucket_counts[object2index[o]] += 1
+    compared = [None] * len(bucket_counts)
+    match_count = 0
+    # This whole 'popping' thing is there to avoid taking too much memory at the same time.
+    while word_dict:
+        items = sorted((object2index[o], o) for o in word_dict.popitem()[1])
+        for position, (ref_index, ref) in enumerate(items):
+            ref_ids = word_ids[ref]
+            ref_compared = compared[ref_index]
+            record = bucket_counts[ref_index] > 1
+            newly_compared = []
+            for other_index, other in itertools.islice(items, position + 1, None):
+                if ref_compared is not None:
+                    pos = bisect.bisect_left(ref_compared, other_index)
+                    if pos < len(ref_compared) and ref_compared[pos] == other_index:
+                        continue
+                if record and bucket_counts[other_index] > 1:
+                    newly_compared.append(other_index)
+                percentage = vocabulary.compare(ref_ids, word_ids[other], match_flags)
+                if percentage >= min_match_percentage:
+                    match_count += 1
+                    yield Match(ref, other, percentage)
+            if newly_compared:
+                if ref_compared is None:
+                    compared[ref_index] = array('I', newly_compared)
+                else:
+                    # Both are sorted, which makes sorting them together a merge.
+                    ref_compared.extend(newly_compared)
+                    compared[ref_index] = array('I', sorted(ref_compared))
+        for index, o in items:
+            bucket_counts[index] -= 1
+            if not bucket_counts[index]:
+                compared[index] = None
+        j.add_progress(desc=tr("%d matches found") % match_count)
+
+
+# Worker processes of _iter_bucket_matches_in_processes() keep what they need to compare objects
+# here. It's set once per process by _init_worker() so that tasks only have to hold bucket ranks.
+_worker_state = None
+
+def _init_worker(words, word_ids, buckets, object_buckets, match_flags, min_match_percentage):
+    global _worker_state
+    vocabulary = Vocabulary(words)
+    _worker_state = (vocabulary, word_ids, buckets, object_buckets, match_flags, min_match_percentage)
+
+def _compare_buckets(task):
+    # ``task`` is a list of (rank, start, stop) in which each object of buckets[rank][start:stop]
+    # has to be compared with the objects that follow it in the bucket. A pair sharing more than
+    # one bucket is only compared in the one with the lowest rank. Returns a list of
+    # (first, second, percentage) with objects as indexes in word_ids.
+    vocabulary, word_ids, buckets, object_buckets, match_flags, min_match_percentage = _worker_state
+    result = []
+    for rank, start, stop in task:
+        bucket = buckets[rank]
+        for index in range(start, stop):
+            first = bucket[index]
+            first_ids = word_ids[first]
+            first_buckets = object_buckets[first]
+            for second in itertools.islice(bucket, index + 1, None):
+                if min(first_buckets & object_buckets[second]) < rank:
+                    continue
+                percentage = vocabulary.compare(first_ids, word_ids[second], match_flags)
+                if percentage >= min_match_percentage:
+                    result.append((first, second, percentage))
+    return result
+
+def _get_bucket_tasks(buckets, task_count):
+    # Splits the pairs of ``buckets`` in about ``task_count`` tasks of about the same size, for
+    # _compare_buckets(). Big buckets are split across tasks.
+    pair_count = sum(len(bucket) * (len(bucket) - 1) // 2 for bucket in buckets)
+    task_size = max(pair_count // task_count, 1)
+    tasks = []
+    task = []
+    size = 0
+    for rank, bucket in enumerate(buckets):
+        start = 0
+        for index in range(len(bucket) - 1):
+            size += len(bucket) - index - 1
+            if size >= task_size:
+                task.append((rank, start, index + 1))
+                tasks.append(task)
+                task = []
+                size = 0
+                start = index + 1
+        if start < len(bucket) - 1:
+            task.append((rank, start, len(bucket) - 1))
+    if task:
+        tasks.append(task)
+    return tasks
+
+def _iter_bucket_matches_in_processes(
+        word_dict, word_ids, vocabulary, match_flags, min_match_percentage, process_count, j):
+    # Same as _iter_bucket_matches(), but buckets are compared by a pool of ``process_count``
+    # processes. Only word IDs and indexes are sent to processes, never the objects themselves.
+    buckets = [objects for objects in word_dict.values() if len(objects) > 1]
+    word_dict.clear()
+    objects = list({o: None for bucket in buckets for o in bucket})
+    object2index = {o: index for index, o in enumerate(objects)}
+    buckets = [[object2index[o] for o in bucket] for bucket in buckets]
+    object_buckets = [set() for o in objects]
+    for rank, bucket in enumerate(buckets):
+        for index in bucket:
+            object_buckets[index].add(rank)
+    object_buckets = [frozenset(ranks) for ranks in object_buckets]
+    tasks = _get_bucket_tasks(buckets, process_count * TASKS_PER_PROCESS)
+    initargs = (
+        vocabulary.words, [word_ids[o] for o in objects], buckets, object_buckets, match_flags,
+        min_match_percentage
+    )
+    del object2index, object_buckets
+    j.start_job(len(tasks), tr("0 matches found"))
+    match_count = 0
+    pool = multiprocessing.Pool(process_count, _init_worker, initargs)
+    try:
+        for matches in pool.imap(_compare_buckets, tasks):
+            for first, second, percentage in matches:
+                yield Match(objects[first], objects[second], percentage)
+            match_count += len(matches)
+            j.add_progress(desc=tr("%d matches found") % match_count)
+        pool.close()
+    finally:
+        # When the job is cancelled or when we stop consuming matches, we don't wait for the rest.
+        pool.terminate()
+
+def _iter_prefix_matches(
+        word_dict, word_ids, vocabulary, word_frequencies, match_flags, min_match_percentage, j):
+    # Yields the same matches as _iter_bucket_matches() for flat word lists, but only compares pairs
+    # that can reach min_match_percentage: pairs that share a word in their prefixes (see
+    # _get_prefix_words()) and that aren't too far apart in weight.
+    # Objects are processed from the lightest to the heaviest and looked up in two indexes of the
+    # objects processed before them: one by prefix word and one by word_dict bucket. Candidates are
+    # taken from the index with the shortest lists and checked against the other. Because weights
+    # only go up, objects that are too light are trimmed from the indexes for good.
+    if WEIGHT_WORDS in match_flags:
+        get_weight = vocabulary.get_length
+    else:
+        def get_weight(word):
+            return 1
+
+    def sort_key(word):
+        return (word_frequencies.get(word, 0), word)
+
+    def get_postings(index, words):
+        result = []
+        for word in words:
+            postings, start = index[word]
+            while start < len(postings) and weights[postings[start]] * weight_factor < min_weight:
+                start += 1
+            index[word][1] = start
+            result.append((postings, start))
+        return result
+
+    def get_candidates(postings_list):
+        candidates = set()
+        for postings, start in postings_list:
+            candidates.update(itertools.islice(postings, start, None))
+        return candidates
+
+    buckets = defaultdict(list)
+    for word, objects in word_dict.items():
+        for o in objects:
+            buckets[o].append(word)
+    weights = {o: sum(map(get_weight, word_ids[o])) for o in buckets}
+    objects = sorted(buckets, key=weights.__getitem__)
+    prefixes = {}
+    weight_factor = 401 - 2 * min_match_percentage
+    prefix_index = defaultdict(lambda: [[], 0])
+    bucket_index = defaultdict(lambda: [[], 0])
+    match_count = 0
+    j.start_job(len(objects), tr("0 matches found"))
+    for i, o in enumerate(objects):
+        if i % JOB_REFRESH_RATE == JOB_REFRESH_RATE - 1:
+            j.add_progress(JOB_REFRESH_RATE, desc=tr("%d matches found") % match_count)
+        o_ids = word_ids[o]
+        o_prefix = _get_prefix_words(o_ids, sort_key, get_weight, min_match_percentage)
+        o_buckets = buckets[o]
+        min_weight = (2 * min_match_percentage - 1) * weights[o]
+        prefix_postings = get_postings(prefix_index, o_prefix)
+        bucket_postings = get_postings(bucket_index, o_buckets)
+        prefix_count = sum(len(postings) - start for postings, start in prefix_postings)
+        bucket_count = sum(len(postings) - start for postings, start in bucket_postings)
+        if prefix_count <= bucket_count:
+            o_buckets = set(o_buckets)
+            candidates = [
+                other for other in get_candidates(prefix_postings)
+                if not o_buckets.isdisjoint(buckets[other])
+            ]
+        else:
+            o_prefix = set(o_prefix)
+            candidates = [
+                other for other in get_candidates(bucket_postings)
+                if not o_prefix.isdisjoint(prefixes[other])
+            ]
+        for other in candidates:
+            percentage = vocabulary.compare(word_ids[other], o_ids, match_flags)
+            if percentage >= min_match_percentage:
+                match_count += 1
+                yield Match(other, o, percentage)
+        prefixes[o] = o_prefix
+        for postings, start in prefix_postings:
+            postings.append(o)
+        for postings, start in bucket_postings:
+            postings.append(o)
+
+def _get_minhashes(word, count):
+    # Returns ``count`` 32-bit hashes of ``word``. Each position in the array acts as a different
+    # hash function for MinHash signatures.
+    data = word.encode('utf-8')
+    digests = b''.join(hashlib.sha512(bytes([i]) + data).digest() for i in range((count + 15) // 16))
+    return array('I', digests[:count * 4])
+
+def _iter_lsh_matches(
+        objects, word_ids, vocabulary, match_flags, min_match_percentage, bands, rows, sj, j):
+    # Yields the matches among objects whose MinHash signatures share at least one band of ``rows``
+    # hashes. Memory usage depends on the number of different signatures, not on the number of
+    # pairs. A pair sharing more than one band is only compared in the first one.
+    hash_count = bands * rows
+    word_minhashes = {}
+    signature2objects = defaultdict(list)
+    for o in sj.iter_with_progress(objects, tr("Hashed %d/%d files"), JOB_REFRESH_RATE):
+        ids = word_ids[o]
+        if ids and isinstance(ids[0], tuple):
+            ids = itertools.chain.from_iterable(ids)
+        minhashes = []
+        for word in set(ids):
+            if word not in word_minhashes:
+                word_minhashes[word] = _get_minhashes(vocabulary.words[word], hash_count)
+            minhashes.append(word_minhashes[word])
+        if not minhashes:
+            continue
+        if len(minhashes) > 1:
+            signature = array('I', map(min, *minhashes))
+        else:
+            signature = minhashes[0]
+        signature2objects[signature.tobytes()].append(o)
+    del word_minhashes
+    signatures = list(signature2objects.items())
+    del signature2objects
+    band_size = rows * array('I').itemsize
+    match_count = 0
+
+    def iter_same_signature_pairs():
+        # Objects with the same signature share all bands.
+        for signature, group in signatures:
+            yield from itertools.combinations(group, 2)
+
+    def iter_band_pairs(start):
+        buckets = defaultdict(list)
+        for signature, group in signatures:
+            buckets[signature[start:start+band_size]].append((signature, group))
+        for bucket in buckets.values():
+            for (sig1, group1), (sig2, group2) in itertools.combinations(bucket, 2):
+                if any(sig1[i:i+band_size] == sig2[i:i+band_size] for i in range(0, start, band_size)):
+                    continue
+                yield from itertools.product(group1, group2)
+
+    j.start_job(bands + 1, tr("0 matches found"))
+    band_pairs = (iter_band_pairs(start) for start in range(0, band_size * bands, band_size))
+    for pairs in itertools.chain([iter_same_signature_pairs()], band_pairs):
+        for first, second in pairs:
+            percentage = vocabulary.compare(word_ids[first], word_ids[second], match_flags)
+            if percentage >= min_match_percentage:
+                match_count += 1
+                yield Match(first, second, percentage)
+        j.add_progress(desc=tr("%d matches found") % match_count)
+
+def _iter_exact_matches(
+        objects, word_ids, vocabulary, match_flags, min_match_percentage, common_word_threshold,
+        process_count, sj, j):
+    # Yields the matches among objects sharing a word that isn't common.
+    word_dict = build_word_dict(objects, sj)
+    # Pairs that can't reach min_match_percentage because of their word counts (or weights) are
+    # pruned before being compared. This doesn't work with similar words, which can match words
+    # that aren't the same, nor with fields.
+    has_fields = any(words and isinstance(words[0], tuple) for words in word_ids.values())
+    similar_words = MATCH_SIMILAR_WORDS in match_flags
+    prune = min_match_percentage > 0 and not similar_words and not has_fields
+    if prune:
+        word_frequencies = {vocabulary.intern(word): len(os) for word, os in word_dict.items()}
+    reduce_common_words(word_dict, common_word_threshold)
+    if similar_words:
+        merge_similar_words(word_dict, vocabulary.similar_word_index)
+    if prune:
+        yield from _iter_prefix_matches(
+            word_dict, word_ids, vocabulary, word_frequencies, match_flags, min_match_percentage, j
+        )
+    elif process_count > 1 and len(objects) >= MIN_OBJECTS_FOR_PROCESSES:
+        yield from _iter_bucket_matches_in_processes(
+            word_dict, word_ids, vocabulary, match_flags, min_match_percentage, process_count, j
+        )
+    else:
+        j.start_job(len(word_dict), tr("0 matches found"))
+        yield from _iter_bucket_matches(
+            word_dict, word_ids, vocabulary, match_flags, min_match_percentage, j
+        )
+
 # Writing docstrings in a namedtuple is tricky. From Python 3.3, it's possible to set __doc__, but
 # some research allowed me to find a more elegant solution, which is what is done here. See
 # http://stackoverflow.com/questions/1606436/adding-docstrings-to-namedtuples-in-python
@@ -189,29 +851,40 @@ def get_match(first, second, flags=()):
     percentage = compare(first.words, second.words, flags)
     return Match(first, second, percentage)
 
-def getmatches(
+def itermatches(
         objects, min_match_percentage=0, match_similar_words=False, weight_words=False,
-        no_field_order=False, j=job.nulljob):
-    """Returns a list of :class:`Match` within ``objects`` after fuzzily matching their words.
+        no_field_order=False, approximate=False, lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS,
+        process_count=1, j=job.nulljob):
+    """Yields :class:`Match` within ``objects`` after fuzzily matching their words.
+
+    Matches are yielded as they are found, so that they can be filtered and grouped without having
+    all of them in memory at once.
+
+    With ``approximate``, the pairs to compare are picked with `MinHash LSH
+    <https://en.wikipedia.org/wiki/Locality-sensitive_hashing>`_ on the word sets of ``objects``
+    instead of being all pairs sharing a word. It's much faster on big sets and common words
+    don't have to be ignored, but some matches can be missed, especially lower ones. Similar
+    words are matched, but only between pairs that have been picked.
 
     :param objects: List of :class:`~core.fs.File` to match.
     :param int min_match_percentage: minimum % of words that have to match.
     :param bool match_similar_words: make similar words (see :func:`merge_similar_words`) match.
     :param bool weight_words: longer words are worth more in match % computations.
     :param bool no_field_order: match :ref:`fields` regardless of their order.
+    :param bool approximate: pick the pairs to compare with LSH.
+    :param int lsh_bands: number of LSH bands. More bands find more matches.
+    :param int lsh_rows: number of hashes per LSH band. More rows pick less pairs to compare.
+    :param int process_count: number of processes comparing pairs. Scans that can't prune pairs
+                              (:ref:`fields`, similar words or no minimum %) of at least
+                              ``MIN_OBJECTS_FOR_PROCESSES`` objects use them.
     :param j: A :ref:`job progress instance <jobs>`.
     """
     COMMON_WORD_THRESHOLD = 50
-    LIMIT = 5000000
     j = j.start_subjob(2)
     sj = j.start_subjob(2)
-    for o in objects:
-        if not hasattr(o, 'words'):
-            o.words = getwords(o.name)
-    word_dict = build_word_dict(objects, sj)
-    reduce_common_words(word_dict, COMMON_WORD_THRESHOLD)
-    if match_similar_words:
-        merge_similar_words(word_dict)
+    unworded = [o for o in objects if not hasattr(o, 'words')]
+    for o, words in zip(unworded, getwords_multiple([o.name for o in unworded])):
+        o.words = words
     match_flags = []
     if weight_words:
         match_flags.append(WEIGHT_WORDS)
@@ -219,62 +892,284 @@ def getmatches(
         match_flags.append(MATCH_SIMILAR_WORDS)
     if no_field_order:
         match_flags.append(NO_FIELD_ORDER)
-    j.start_job(len(word_dict), tr("0 matches found"))
-    compared = defaultdict(set)
+    vocabulary = Vocabulary()
+    word_ids = {o: vocabulary.intern_words(o.words) for o in objects}
+    if approximate:
+        yield from _iter_lsh_matches(
+            objects, word_ids, vocabulary, match_flags, min_match_percentage, lsh_bands, lsh_rows,
+            sj, j
+        )
+    else:
+        yield from _iter_exact_matches(
+            objects, word_ids, vocabulary, match_flags, min_match_percentage, COMMON_WORD_THRESHOLD,
+            process_count, sj, j
+        )
+
+def getmatches(
+        objects, min_match_percentage=0, match_similar_words=False, weight_words=False,
+        no_field_order=False, approximate=False, lsh_bands=LSH_BANDS, lsh_rows=LSH_ROWS,
+        process_count=1, j=job.nulljob):
+    """Returns a list of :class:`Match` within ``objects`` after fuzzily matching their words.
+
+    Arguments are the same as :func:`itermatches`. Unless ``approximate`` is set, the number of
+    matches is limited to ``LIMIT``. If we run out of memory, matches found so far are returned.
+    """
+    LIMIT = 5000000
+    if approximate:
+        # The number of pairs compared doesn't explode with common words, we don't need a limit.
+        LIMIT = None
+    matches = itermatches(
+        objects, min_match_percentage=min_match_percentage,
+        match_similar_words=match_similar_words, weight_words=weight_words,
+        no_field_order=no_field_order, approximate=approximate, lsh_bands=lsh_bands,
+        lsh_rows=lsh_rows, process_count=process_count, j=j
+    )
     result = []
     try:
-        # This whole 'popping' thing is there to avoid taking too much memory at the same time.
-        while word_dict:
-            items = word_dict.popitem()[1]
-            while items:
-                ref = items.pop()
-                compared_already = compared[ref]
-                to_compare = items - compared_already
-                compared_already |= to_compare
-                for other in to_compare:
-                    m = get_match(ref, other, match_flags)
-                    if m.percentage >= min_match_percentage:
-                        result.append(m)
-                        if len(result) >= LIMIT:
-                            return result
-            j.add_progress(desc=tr("%d matches found") % len(result))
+        for match in matches:
+            result.append(match)
+            if len(result) == LIMIT:
+                break
     except MemoryError:
         # This is the place where the memory usage is at its peak during the scan.
-        # Just continue the process with an incomplete list of matches.
-        del compared # This should give us enough room to call logging.
-        logging.warning('Memory Overflow. Matches: %d. Word dict: %d' % (len(result), len(word_dict)))
-        return result
+        # Just continue the process with an incomplete list of matches. The matching generator
+        # is done at this point, which should give us enough room to call logging.
+        logging.warning('Memory Overflow. Matches: %d' % len(result))
     return result
 
-def getmatches_by_contents(files, sizeattr='size', partial=False, j=job.nulljob):
-    """Returns a list of :class:`Match` within ``files`` if their contents is the same.
+def _get_contents_buckets(buckets):
+    # Files alone in their bucket can't match anything, and neither can files in a bucket that only
+    # contains ref files, since we don't compare ref files together.
+    return [files for files in buckets if len(files) > 1 and not all(f.is_ref for f in files)]
+
+def _read_attribute_in_threads(files, attrname, thread_count, j, desc):
+    # Reads ``attrname`` of every file in a pool of ``thread_count`` threads so that it's cached
+    # when we need it. Errors are logged, they will come up again when the attribute is read.
+    def read(file):
+        getattr(file, attrname)
+
+    executor = ThreadPoolExecutor(thread_count)
+    pending_count = thread_count * PENDING_READS_PER_THREAD
+    files = iter(files)
+    future2file = {}
+    try:
+        while True:
+            for file in itertools.islice(files, pending_count - len(future2file)):
+                future2file[executor.submit(read, file)] = file
+            if not future2file:
+                break
+            done, _ = wait(future2file, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = future2file.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.warning("Couldn't read %s of %r: %s", attrname, getattr(file, 'path', file), e)
+                j.add_progress(desc=desc)
+    finally:
+        # When the job is cancelled, we only wait for the files that are being read.
+        for future in future2file:
+            future.cancel()
+        executor.shutdown()
+
+def _iter_same_blocks_groups(files, j):
+    # Reads ``files`` in lockstep, block by block, and splits them in groups as soon as their
+    # blocks differ. Files that are alone in their group aren't read any further. Yields groups of
+    # files that were identical up to their end.
+    opened = []
+    try:
+        for file in files:
+            try:
+                opened.append((file, file.path.open('rb')))
+            except EnvironmentError as e:
+                logging.warning("Couldn't read %r: %s", file.path, e)
+        groups = [opened] if len(opened) > 1 else []
+        while groups:
+            j.check_if_cancelled()
+            next_groups = []
+            for group in groups:
+                block2files = defaultdict(list)
+                for file, fp in group:
+                    try:
+                        block2files[fp.read(COMPARE_BLOCK_SIZE)].append((file, fp))
+                    except EnvironmentError as e:
+                        logging.warning("Couldn't read %r: %s", file.path, e)
+                for block, same_files in block2files.items():
+                    if len(same_files) < 2:
+                        continue
+                    if block:
+                        next_groups.append(same_files)
+                    else: # end of file
+                        yield [file for file, fp in same_files]
+            groups = next_groups
+    finally:
+        for file, fp in opened:
+            fp.close()
+
+def itermatches_by_contents(
+        files, sizeattr='size', partial=False, thread_count=1, cache_path=None, cache_roots=None,
+        bytewise=False, signatureattr=None, j=job.nulljob):
+    """Yields :class:`Match` within ``files`` if their contents is the same, as they are found.
+
+    Files are compared in stages, from the cheapest to the most expensive: size, ``md5head``,
+    ``md5partial``, ``md5samples`` and then ``md5``. At each stage, the remaining files are bucketed by the stage's
+    value and files that end up alone in their bucket are dropped, so that a file is only entirely
+    read if all cheaper stages couldn't tell it apart from another.
 
     :param str sizeattr: attibute name of the :class:`~core.fs.file` that returns the size of the
                          file to use for comparison.
+    :param str signatureattr: if set, name of an attribute compared right after the size, before
+                              any digest is read. It must be cheap to compute and equal for files
+                              with the same contents, like
+                              :attr:`core.fs.Folder.size_signature`.
     :param bool partial: if true, will use the "md5partial" attribute instead of "md5" to compute
-                         contents hash.
+                         contents hash. ``md5samples`` isn't compared either.
+    :param int thread_count: number of threads reading the digests of a stage. With 1, digests are
+                             read one by one, as they're needed.
+    :param str cache_path: path of a :class:`~core.cache.DigestCache` database. If set, digests
+                           found in it aren't read again and read digests are saved to it.
+    :param cache_roots: if set, outdated records of files under these folders are purged from the
+                        cache before it's used (see :meth:`~core.cache.DigestCache.purge_outdated`).
+    :param bool bytewise: if true, files left after the ``md5samples`` stage are read in lockstep
+                          and compared block by block instead of being hashed. Reading stops at the
+                          first difference and identical files are only read once. Buckets of more
+                          than :data:`COMPARE_MAX_FILE_COUNT` files are still hashed. Ignored when
+                          ``partial`` is true.
     :param j: A :ref:`job progress instance <jobs>`.
     """
+    stages = ['md5head', 'md5partial']
+    if not partial:
+        stages += ['md5samples', 'md5']
+    if signatureattr:
+        stages.insert(0, signatureattr)
     j = j.start_subjob([2, 8])
-    size2files = defaultdict(set)
+    size2files = defaultdict(list)
     for file in j.iter_with_progress(files, tr("Read size of %d/%d files")):
         filesize = getattr(file, sizeattr)
         if filesize:
-            size2files[filesize].add(file)
+            size2files[filesize].append(file)
     del files
-    possible_matches = [files for files in size2files.values() if len(files) > 1]
+    buckets = _get_contents_buckets(size2files.values())
     del size2files
+    # The last stage is the one that reads whole files.
+    j = j.start_subjob([1] * (len(stages) - 1) + [8])
+    if cache_path:
+        cache = DigestCache(cache_path)
+        if cache_roots is not None:
+            cache.purge_outdated(cache_roots)
+    else:
+        cache = None
+    try:
+        yield from _itermatches_by_digests(
+            buckets, stages, thread_count, cache, bytewise and not partial, j
+        )
+    finally:
+        if cache is not None:
+            cache.log_hit_ratio()
+            cache.close()
+
+def _get_links(buckets):
+    # Builds the scan's (st_dev, st_ino) table. Only the first path of each physical file is kept
+    # in its bucket and the other paths are returned in a {kept_file: [other_paths]} dict. Links
+    # have the same size, so they're always in the same bucket.
+    links = {}
     result = []
-    j.start_job(len(possible_matches), tr("0 matches found"))
-    for group in possible_matches:
-        for first, second in itertools.combinations(group, 2):
+    for files in buckets:
+        inode2file = {}
+        kept = []
+        for file in files:
+            if file.inode:
+                key = (file.dev, file.inode)
+                if key in inode2file:
+                    links.setdefault(inode2file[key], []).append(file)
+                    continue
+                inode2file[key] = file
+            kept.append(file)
+        result.append(kept)
+    if links:
+        logging.info(
+            "%d files are links to another scanned file and will share its digests",
+            sum(len(paths) for paths in links.values())
+        )
+    return result, links
+
+def _itermatches_by_digests(buckets, stages, thread_count, cache, bytewise, j):
+    buckets, links = _get_links(buckets)
+    match_count = 0
+
+    def all_paths(files):
+        for file in files:
+            yield file
+            yield from links.get(file, [])
+
+    def iter_same_contents_matches(files):
+        nonlocal match_count
+        for first, second in itertools.combinations(all_paths(files), 2):
             if first.is_ref and second.is_ref:
-                continue # Don't spend time comparing two ref pics together.
-            if first.md5partial == second.md5partial:
-                if partial or first.md5 == second.md5:
-                    result.append(Match(first, second, 100))
-        j.add_progress(desc=tr("%d matches found") % len(result))
-    return result
+                continue # Two ref files are never matched together.
+            match_count += 1
+            yield Match(first, second, 100)
+
+    def split_buckets(buckets):
+        # A file alone in its bucket can only match its own links, so we yield those matches right
+        # away. Returns the buckets that still have to be compared.
+        result = []
+        for files in buckets:
+            if len(files) == 1:
+                if files[0] in links:
+                    yield from iter_same_contents_matches(files)
+            elif not all(path.is_ref for path in all_paths(files)):
+                result.append(files)
+        return result
+
+    buckets = yield from split_buckets(buckets)
+    for stage in stages:
+        is_last_stage = stage == stages[-1]
+        desc = tr("%d matches found") % match_count
+        j.start_job(sum(len(files) for files in buckets), desc)
+        if is_last_stage and bytewise:
+            compared = [files for files in buckets if len(files) <= COMPARE_MAX_FILE_COUNT]
+            buckets = [files for files in buckets if len(files) > COMPARE_MAX_FILE_COUNT]
+            for files in compared:
+                for same_files in _iter_same_blocks_groups(files, j):
+                    yield from iter_same_contents_matches(same_files)
+                j.add_progress(len(files), desc=tr("%d matches found") % match_count)
+        if cache is not None:
+            missing = cache.load((file for files in buckets for file in files), stage)
+        if thread_count > 1:
+            stage_files = (file for files in buckets for file in files)
+            _read_attribute_in_threads(stage_files, stage, thread_count, j, desc)
+        next_buckets = []
+        for files in buckets:
+            digest2files = defaultdict(list)
+            for file in files:
+                digest = getattr(file, stage)
+                digest2files[digest].append(file)
+                for path in links.get(file, []):
+                    setattr(path, stage, digest)
+            if is_last_stage:
+                for same_files in digest2files.values():
+                    yield from iter_same_contents_matches(same_files)
+            else:
+                next_buckets += yield from split_buckets(digest2files.values())
+            if thread_count <= 1:
+                j.add_progress(len(files), desc=tr("%d matches found") % match_count)
+        if cache is not None:
+            cache.save(missing, stage)
+        buckets = next_buckets
+
+def getmatches_by_contents(
+        files, sizeattr='size', partial=False, thread_count=1, cache_path=None, cache_roots=None,
+        bytewise=False, signatureattr=None, j=job.nulljob):
+    """Returns a list of :class:`Match` within ``files`` if their contents is the same.
+
+    Arguments are the same as :func:`itermatches_by_contents`.
+    """
+    return list(itermatches_by_contents(
+        files, sizeattr=sizeattr, partial=partial, thread_count=thread_count,
+        cache_path=cache_path, cache_roots=cache_roots, bytewise=bytewise,
+        signatureattr=signatureattr, j=j
+    ))
 
 class Group:
     """A group of :class:`~core.fs.File` that match together.
@@ -292,23 +1187,36 @@ class Group:
 
     .. attribute:: unordered
 
-        Set duplicates in the group (including the :attr:`ref`).
+        Set-like view of the duplicates in the group (including the :attr:`ref`).
 
     .. attribute:: dupes
 
         An ordered list of the group's duplicate, without :attr:`ref`. Equivalent to
         ``ordered[1:]``
 
+    .. attribute:: matches
+
+        Set of :class:`Match` recorded in the group, including those with candidates that didn't
+        make it in the group until :meth:`discard_matches` is called.
+
     .. attribute:: percentage
 
         Average match percentage of match pairs containing :attr:`ref`.
     """
+    # Results can hold a lot of groups, so we keep them small. Every duplicate gets an index, in the
+    # order they're added to the group, and the matches between duplicates are kept in a flat
+    # triangular array of percentages in which the pair (i, j), with i < j, is at j*(j-1)//2 + i.
+    # Values are offset by one so that 0 means "no match", and they're negative when the duplicate
+    # with the highest index is the first of the match. Matches with candidates are kept in a dict
+    # of dicts ({candidate: {other: match}}) until the candidate is accepted or discarded.
+    __slots__ = ('ordered', '_indexes', '_index_count', '_percentages', '_candidates', '_percentage')
+
     #---Override
     def __init__(self):
         self._clear()
 
     def __contains__(self, item):
-        return item in self.unordered
+        return item in self._indexes
 
     def __getitem__(self, key):
         return self.ordered.__getitem__(key)
@@ -322,17 +1230,76 @@ class Group:
     #---Private
     def _clear(self):
         self._percentage = None
-        self._matches_for_ref = None
-        self.matches = set()
-        self.candidates = defaultdict(set)
+        self._candidates = None
+        self._indexes = {}
+        self._index_count = 0
+        self._percentages = array('h')
         self.ordered = []
-        self.unordered = set()
 
-    def _get_matches_for_ref(self):
-        if self._matches_for_ref is None:
-            ref = self.ref
-            self._matches_for_ref = [match for match in self.matches if ref in match]
-        return self._matches_for_ref
+    def _add_dupe(self, item):
+        index = self._index_count
+        self._index_count += 1
+        self._percentages.frombytes(bytes(index * self._percentages.itemsize))
+        indexes = self._indexes
+        indexes[item] = index
+        self.ordered.append(item)
+        self._percentage = None
+        for other, match in self._candidates.pop(item).items():
+            if other in indexes:
+                self._set_match(match)
+
+    def _add_candidate(self, item, other, match):
+        candidates = self._candidates
+        if candidates is None:
+            candidates = self._candidates = {}
+        matches = candidates.get(item)
+        if matches is None:
+            matches = candidates[item] = {other: match}
+        elif other in matches:
+            return
+        else:
+            matches[other] = match
+        if matches.keys() >= self._indexes.keys():
+            self._add_dupe(item)
+
+    def _get_value(self, item, other):
+        # Returns the stored value of the (item, other) pair, negative if ``other`` is the first
+        # file of the match.
+        index = self._indexes[item]
+        other_index = self._indexes[other]
+        if index < other_index:
+            return self._percentages[other_index * (other_index - 1) // 2 + index]
+        else:
+            return -self._percentages[index * (index - 1) // 2 + other_index]
+
+    def _get_match(self, item, other):
+        indexes = self._indexes
+        index = indexes[item]
+        other_index = indexes[other]
+        if index < other_index:
+            value = self._percentages[other_index * (other_index - 1) // 2 + index]
+        else:
+            value = -self._percentages[index * (index - 1) // 2 + other_index]
+        if value > 0:
+            return Match(item, other, value - 1)
+        elif value < 0:
+            return Match(other, item, -value - 1)
+
+    def _set_match(self, match):
+        first, second, percentage = match
+        index = self._indexes[first]
+        other_index = self._indexes[second]
+        if index == other_index:
+            return False
+        value = percentage + 1
+        if index > other_index:
+            index, other_index, value = other_index, index, -value
+        position = other_index * (other_index - 1) // 2 + index
+        if self._percentages[position]:
+            return False
+        self._percentages[position] = value
+        self._percentage = None
+        return True
 
     #---Public
     def add_match(self, match):
@@ -345,42 +1312,37 @@ class Group:
 
         :param tuple match: pair of :class:`~core.fs.File` to add
         """
-        def add_candidate(item, match):
-            matches = self.candidates[item]
-            matches.add(match)
-            if self.unordered <= matches:
-                self.ordered.append(item)
-                self.unordered.add(item)
-
-        if match in self.matches:
-            return
-        self.matches.add(match)
         first, second, _ = match
-        if first not in self.unordered:
-            add_candidate(first, second)
-        if second not in self.unordered:
-            add_candidate(second, first)
-        self._percentage = None
-        self._matches_for_ref = None
+        indexes = self._indexes
+        if first in indexes:
+            if second in indexes:
+                self._set_match(match)
+            else:
+                self._add_candidate(second, first, match)
+        else:
+            self._add_candidate(first, second, match)
+            if second not in indexes:
+                self._add_candidate(second, first, match)
 
     def discard_matches(self):
         """Remove all recorded matches that didn't result in a duplicate being added to the group.
 
         You can call this after the duplicate scanning process to free a bit of memory.
         """
-        discarded = set(m for m in self.matches if not all(obj in self.unordered for obj in [m.first, m.second]))
-        self.matches -= discarded
-        self.candidates = defaultdict(set)
+        discarded = set()
+        if self._candidates:
+            for matches in self._candidates.values():
+                discarded.update(matches.values())
+        self._candidates = None
         return discarded
 
     def get_match_of(self, item):
         """Returns the match pair between ``item`` and :attr:`ref`.
         """
-        if item is self.ref:
+        ref = self.ref
+        if item is ref or item not in self._indexes:
             return
-        for m in self._get_matches_for_ref():
-            if item in m:
-                return m
+        return self._get_match(ref, item)
 
     def prioritize(self, key_func, tie_breaker=None):
         """Reorders :attr:`ordered` according to ``key_func``.
@@ -410,15 +1372,13 @@ class Group:
         return changed
 
     def remove_dupe(self, item, discard_matches=True):
+        # Indexes aren't reused, so the matches of a removed dupe can't be reached anymore and
+        # there's nothing else to discard, whatever ``discard_matches`` is.
         try:
             self.ordered.remove(item)
-            self.unordered.remove(item)
+            del self._indexes[item]
             self._percentage = None
-            self._matches_for_ref = None
-            if (len(self) > 1) and any(not getattr(item, 'is_ref', False) for item in self):
-                if discard_matches:
-                    self.matches = set(m for m in self.matches if item not in m)
-            else:
+            if not ((len(self) > 1) and any(not getattr(item, 'is_ref', False) for item in self)):
                 self._clear()
         except ValueError:
             pass
@@ -432,76 +1392,154 @@ class Group:
             self.ordered.remove(with_dupe)
             self.ordered.insert(0, with_dupe)
             self._percentage = None
-            self._matches_for_ref = None
             return True
         except ValueError:
             return False
 
     dupes = property(lambda self: self[1:])
 
+    candidates = property(lambda self: self._candidates or {})
+
+    unordered = property(lambda self: self._indexes.keys())
+
+    @property
+    def matches(self):
+        items = [None] * self._index_count
+        for item, index in self._indexes.items():
+            items[index] = item
+        result = set()
+        for other_index, other in enumerate(items):
+            if other is None:
+                continue
+            for index in range(other_index):
+                if items[index] is not None:
+                    match = self._get_match(items[index], other)
+                    if match is not None:
+                        result.add(match)
+        if self._candidates:
+            for matches in self._candidates.values():
+                result.update(matches.values())
+        return result
+
+    @matches.setter
+    def matches(self, matches):
+        self._percentages = array('h', itertools.repeat(0, len(self._percentages)))
+        self._candidates = None
+        self._percentage = None
+        for match in matches:
+            first, second, _ = match
+            if first in self._indexes and second in self._indexes:
+                self._set_match(match)
+            else:
+                if self._candidates is None:
+                    self._candidates = {}
+                for item, other in [(first, second), (second, first)]:
+                    if item not in self._indexes:
+                        self._candidates.setdefault(item, {}).setdefault(other, match)
+
     @property
     def percentage(self):
         if self._percentage is None:
-            if self.dupes:
-                matches = self._get_matches_for_ref()
-                self._percentage = sum(match.percentage for match in matches) // len(matches)
-            else:
-                self._percentage = 0
+            ref = self.ref
+            values = (abs(self._get_value(ref, dupe)) for dupe in self.dupes)
+            percentages = [value - 1 for value in values if value]
+            self._percentage = sum(percentages) // len(percentages) if percentages else 0
         return self._percentage
 
     @property
     def ref(self):
-        if self:
-            return self[0]
+        if self.ordered:
+            return self.ordered[0]
+
 
+def _bucket_by_percentage(matches):
+    # Percentages only take a handful of distinct values (0 to 100), so grouping matches in buckets
+    # orders them in linear time. Arrival order is kept within a bucket, like a stable sort would.
+    buckets = defaultdict(list)
+    try:
+        for match in matches:
+            buckets[match[2]].append(match)
+    except MemoryError:
+        # When ``matches`` is streamed from the engine, this is the place where the memory usage is
+        # at its peak during the scan. Just continue the process with an incomplete list of
+        # matches. The matching generator is done at this point, which should give us enough room
+        # to call logging.
+        logging.warning('Memory Overflow. Matches: %d' % sum(len(b) for b in buckets.values()))
+    return [buckets[percentage] for percentage in sorted(buckets, reverse=True)]
 
 def get_groups(matches, j=job.nulljob):
     """Returns a list of :class:`Group` from ``matches``.
 
-    Create groups out of match pairs in the smartest way possible.
+    Create groups out of match pairs in the smartest way possible. ``matches`` can be any iterable
+    of :class:`Match`, such as what :func:`itermatches` yields. It's consumed only once, and matches
+    are processed from the highest percentage to the lowest.
     """
-    matches.sort(key=lambda match: -match.percentage)
-    dupe2group = {}
+    buckets = _bucket_by_percentage(matches)
+    match_count = sum(len(bucket) for bucket in buckets)
+    # The job is started only now because consuming ``matches`` may drive the progress of the job
+    # that produces them.
+    j.start_job(100, tr("Grouped %d/%d matches") % (0, match_count))
+    grouped_count = 0
+
+    def add_progress(count):
+        nonlocal grouped_count
+        grouped_count += count
+        desc = tr("Grouped %d/%d matches") % (grouped_count, match_count)
+        j.set_progress(grouped_count * 100 // max(match_count, 1), desc)
+
     groups = []
-    try:
-        for match in j.iter_with_progress(matches, tr("Grouped %d/%d matches"), JOB_REFRESH_RATE):
-            first, second, _ = match
-            first_group = dupe2group.get(first)
-            second_group = dupe2group.get(second)
-            if first_group:
-                if second_group:
-                    if first_group is second_group:
-                        target_group = first_group
-                    else:
-                        continue
-                else:
-                    target_group = first_group
-                    dupe2group[second] = target_group
-            else:
-                if second_group:
-                    target_group = second_group
-                    dupe2group[first] = target_group
-                else:
-                    target_group = Group()
-                    groups.append(target_group)
-                    dupe2group[first] = target_group
-                    dupe2group[second] = target_group
-            target_group.add_match(match)
-    except MemoryError:
-        del dupe2group
-        del matches
-        # should free enough memory to continue
-        logging.warning('Memory Overflow. Groups: {0}'.format(len(groups)))
-    # Now that we have a group, we have to discard groups' matches and see if there're any "orphan"
-    # matches, that is, matches that were candidate in a group but that none of their 2 files were
-    # accepted in the group. With these orphan groups, it's safe to build additional groups
-    matched_files = set(flatten(groups))
-    orphan_matches = []
-    for group in groups:
-        orphan_matches += {
-            m for m in group.discard_matches()
-            if not any(obj in matched_files for obj in [m.first, m.second])
-        }
-    if groups and orphan_matches:
-        groups += get_groups(orphan_matches) # no job, as it isn't supposed to take a long time
+    while buckets:
+        dupe2group = {}
+        new_groups = []
+        try:
+            for bucket in buckets:
+                for start in range(0, len(bucket), JOB_REFRESH_RATE):
+                    chunk = bucket[start:start+JOB_REFRESH_RATE]
+                    for match in chunk:
+                        first, second, _ = match
+                        first_group = dupe2group.get(first)
+                        second_group = dupe2group.get(second)
+                        if first_group is not None:
+                            if second_group is not None:
+                                if first_group is second_group:
+                                    target_group = first_group
+                                else:
+                                    continue
+                            else:
+                                target_group = first_group
+                                dupe2group[second] = target_group
+                        else:
+                            if second_group is not None:
+                                target_group = second_group
+                                dupe2group[first] = target_group
+                            else:
+                                target_group = Group()
+                                new_groups.append(target_group)
+                                dupe2group[first] = target_group
+                                dupe2group[second] = target_group
+                        target_group.add_match(match)
+                    add_progress(len(chunk))
+        except MemoryError:
+            del dupe2group
+            del buckets
+            # should free enough memory to continue
+            logging.warning('Memory Overflow. Groups: {0}'.format(len(groups) + len(new_groups)))
+        groups += new_groups
+        # Now that we have groups, we have to discard groups' matches and see if there're any
+        # "orphan" matches, that is, matches that were candidate in a group but that none of their 2
+        # files were accepted in the group. With these orphan matches, it's safe to build additional
+        # groups, which we do in another round. Files of previous rounds can't be in those orphans,
+        # so only the files of this round's groups have to be checked.
+        matched_files = set(flatten(new_groups))
+        orphan_matches = []
+        for i, group in enumerate(new_groups, start=1):
+            if i % JOB_REFRESH_RATE == 0:
+                j.check_if_cancelled()
+            orphan_matches += {
+                m for m in group.discard_matches()
+                if not (m.first in matched_files or m.second in matched_files)
+            }
+        buckets = _bucket_by_percentage(orphan_matches) if new_groups else []
+        match_count += len(orphan_matches)
+    j.set_progress(100, tr("Grouped %d/%d matches") % (grouped_count, match_count))
     return groups
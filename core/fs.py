@@ -13,9 +13,26 @@
 
 import hashlib
 import logging
+import os
+import threading
+from functools import partial
 
+from hscommon.path import Path
 from hscommon.util import nonone, get_file_ext
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from os import scandir
+except ImportError: # Python < 3.5
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 __all__ = [
     'File',
     'Folder',
@@ -30,6 +47,65 @@ __all__ = [
 
 NOT_SET = object()
 
+# Hash algorithms that can be used to compute the "md5" digests of files. Despite their name, the
+# md5, md5partial and md5head attributes hold digests computed with the file's hash_algorithm.
+# Digests of different algorithms must never be compared together.
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+}
+# blake2b is in hashlib from Python 3.6 and xxh3 in xxhash from 2.0.
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = partial(hashlib.blake2b, digest_size=16)
+if hasattr(xxhash, 'xxh3_64'):
+    HASH_ALGORITHMS['xxh3'] = xxhash.xxh3_64
+if hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+DEFAULT_HASH_ALGORITHM = 'md5'
+# The md5samples digest hashes windows of SAMPLE_SIZE bytes spread evenly from the start to the end
+# of the file: one per SAMPLE_SPACING bytes, with at least 3 (head, middle and tail) and at most
+# MAX_SAMPLE_COUNT. Files smaller than MIN_SAMPLED_SIZE aren't sampled, reading them whole costs
+# about the same.
+SAMPLE_SIZE = 0x4000 # 16Kb
+SAMPLE_SPACING = 64 * 1024 * 1024
+MAX_SAMPLE_COUNT = 16
+MIN_SAMPLED_SIZE = 1024 * 1024
+# Whole files are hashed by reading them in a buffer of that size, which is reused from one file to
+# the next (there's one buffer per thread).
+READ_BUFFER_SIZE = 1024 * 1024
+
+_thread_data = threading.local()
+
+def _get_read_buffer():
+    try:
+        return _thread_data.read_buffer
+    except AttributeError:
+        _thread_data.read_buffer = memoryview(bytearray(READ_BUFFER_SIZE))
+        return _thread_data.read_buffer
+
+def _fadvise(fp, advice):
+    # Hints the kernel about how we read ``fp``, where it's supported.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fp.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+def _hash_file_contents(fp, hasher):
+    # Feeds the whole contents of ``fp``, an unbuffered binary file, to ``hasher`` without
+    # allocating anything per chunk. Once we're done, we tell the kernel that it doesn't need to
+    # keep the file's pages in cache: a scan reads a lot of files only once and shouldn't evict what
+    # other processes need from the page cache.
+    buffer = _get_read_buffer()
+    _fadvise(fp, 'POSIX_FADV_SEQUENTIAL')
+    try:
+        while True:
+            read_count = fp.readinto(buffer)
+            if not read_count:
+                break
+            hasher.update(buffer[:read_count])
+    finally:
+        _fadvise(fp, 'POSIX_FADV_DONTNEED')
+
 class FSError(Exception):
     cls_message = "An error has occured on '{name}' in '{parent}'"
 
@@ -68,16 +144,21 @@ class File:
     INITIAL_INFO = {
         'size': 0,
         'mtime': 0,
+        'dev': 0,
+        'inode': 0,
         'md5': '',
         'md5partial': '',
+        'md5head': '',
+        'md5samples': '',
     }
     # Slots for File make us save quite a bit of memory. In a memory test I've made with a lot of
     # files, I saved 35% memory usage with "unread" files (no _read_info() call) and gains become
     # even greater when we take into account read attributes (70%!). Yeah, it's worth it.
-    __slots__ = ('path', 'is_ref', 'words') + tuple(INITIAL_INFO.keys())
+    __slots__ = ('path', 'is_ref', 'words', 'hash_algorithm') + tuple(INITIAL_INFO.keys())
 
     def __init__(self, path):
         self.path = path
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM
         for attrname in self.INITIAL_INFO:
             setattr(self, attrname, NOT_SET)
 
@@ -101,36 +182,70 @@ class File:
     def _get_md5partial_offset_and_size(self):
         return (0x4000, 0x4000) #16Kb
 
+    #The "head" md5 is the cheapest of our digests and is the first one compared in contents scans.
+    #Like the partial md5, it must only cover data that the full comparison covers.
+    def _get_md5head_offset_and_size(self):
+        return (0, 0x1000) #4Kb
+
+    #The sampled md5 covers windows spread across the whole file. It's compared after md5partial
+    #and before md5, so it must also only cover data that md5 covers.
+    def _get_md5samples_offsets_and_size(self):
+        filesize = self.size
+        if filesize < MIN_SAMPLED_SIZE:
+            return [], 0
+        count = max(3, min(MAX_SAMPLE_COUNT, filesize // SAMPLE_SPACING))
+        last_offset = filesize - SAMPLE_SIZE
+        return [last_offset * i // (count - 1) for i in range(count)], SAMPLE_SIZE
+
     def _read_info(self, field):
-        if field in ('size', 'mtime'):
-            stats = self.path.stat()
-            self.size = nonone(stats.st_size, 0)
-            self.mtime = nonone(stats.st_mtime, 0)
-        elif field == 'md5partial':
+        if field in ('size', 'mtime', 'dev', 'inode'):
+            self._set_stats(self.path.stat())
+        elif field in ('md5partial', 'md5head'):
+            try:
+                if field == 'md5partial':
+                    offset, size = self._get_md5partial_offset_and_size()
+                else:
+                    offset, size = self._get_md5head_offset_and_size()
+                with self.path.open('rb') as fp:
+                    fp.seek(offset)
+                    partialdata = fp.read(size)
+                md5 = self._get_hasher()
+                md5.update(partialdata)
+                setattr(self, field, md5.digest())
+            except Exception:
+                pass
+        elif field == 'md5samples':
             try:
-                fp = self.path.open('rb')
-                offset, size = self._get_md5partial_offset_and_size()
-                fp.seek(offset)
-                partialdata = fp.read(size)
-                md5 = hashlib.md5(partialdata)
-                self.md5partial = md5.digest()
-                fp.close()
+                offsets, size = self._get_md5samples_offsets_and_size()
+                md5 = self._get_hasher()
+                if offsets:
+                    with self.path.open('rb') as fp:
+                        for offset in offsets:
+                            fp.seek(offset)
+                            md5.update(fp.read(size))
+                self.md5samples = md5.digest()
             except Exception:
                 pass
         elif field == 'md5':
             try:
-                fp = self.path.open('rb')
-                md5 = hashlib.md5()
-                CHUNK_SIZE = 8192
-                filedata = fp.read(CHUNK_SIZE)
-                while filedata:
-                    md5.update(filedata)
-                    filedata = fp.read(CHUNK_SIZE)
+                md5 = self._get_hasher()
+                with self.path.open('rb', buffering=0) as fp:
+                    _hash_file_contents(fp, md5)
                 self.md5 = md5.digest()
-                fp.close()
             except Exception:
                 pass
 
+    def _get_hasher(self):
+        return HASH_ALGORITHMS[self.hash_algorithm]()
+
+    def _set_stats(self, stats):
+        self.size = nonone(stats.st_size, 0)
+        self.mtime = nonone(stats.st_mtime, 0)
+        # The stat() of a scandir() entry has no inode on Windows, it's then read from the path.
+        if stats.st_ino:
+            self.dev = stats.st_dev
+            self.inode = stats.st_ino
+
     def _read_all_info(self, attrnames=None):
         """Cache all possible info.
 
@@ -186,16 +301,32 @@ class Folder(File):
 
     It has the size/md5 info of a File, but it's value are the sum of its subitems.
     """
-    __slots__ = File.__slots__ + ('_subfolders', )
+    INITIAL_INFO = File.INITIAL_INFO.copy()
+    INITIAL_INFO.update({
+        'size_signature': '',
+    })
+    __slots__ = File.__slots__ + ('_subfolders', '_items', 'size_signature')
 
     def __init__(self, path):
         File.__init__(self, path)
         self._subfolders = None
+        self._items = None
+
+    def _list_items(self):
+        # The folder is listed once and its items are kept, so that the folder's size and digests
+        # are all aggregated from the same children, which each read their own info only once.
+        # Subfolders are shared with the directory walk, so a whole tree is computed bottom-up.
+        files, folder_paths = get_files_and_folders(self.path)
+        subfolders = [self.__class__(path) for path in folder_paths]
+        self._subfolders = subfolders
+        self._items = sorted(subfolders + files, key=lambda f: f.path)
 
     def _all_items(self):
-        folders = self.subfolders
-        files = get_files(self.path)
-        return folders + files
+        if self._items is None:
+            self._list_items()
+        for item in self._items:
+            item.hash_algorithm = self.hash_algorithm
+        return self._items
 
     def _read_info(self, field):
         if field in {'size', 'mtime'}:
@@ -203,25 +334,34 @@ class Folder(File):
             self.size = size
             stats = self.path.stat()
             self.mtime = nonone(stats.st_mtime, 0)
-        elif field in {'md5', 'md5partial'}:
+        elif field in {'dev', 'inode'}:
+            stats = self.path.stat()
+            self.dev = stats.st_dev
+            self.inode = stats.st_ino
+        elif field == 'size_signature':
+            # A digest of the folder's structure: the size of each of its files and the signature
+            # of each of its subfolders, in the same order as for md5. It's only computed from
+            # sizes, but two folders with the same md5 always have the same signature.
+            md5 = self._get_hasher()
+            for item in self._all_items():
+                if isinstance(item, Folder):
+                    md5.update(b'd' + item.size_signature)
+                else:
+                    md5.update(b'f' + item.size.to_bytes(8, 'little'))
+            self.size_signature = md5.digest()
+        elif field in {'md5', 'md5partial', 'md5head', 'md5samples'}:
             # What's sensitive here is that we must make sure that subfiles'
-            # md5 are always added up in the same order, but we also want a
-            # different md5 if a file gets moved in a different subdirectory.
-            def get_dir_md5_concat():
-                items = self._all_items()
-                items.sort(key=lambda f: f.path)
-                md5s = [getattr(f, field) for f in items]
-                return b''.join(md5s)
-
-            md5 = hashlib.md5(get_dir_md5_concat())
+            # md5 are always added up in the same order (items are sorted by path), but we also
+            # want a different md5 if a file gets moved in a different subdirectory.
+            md5 = self._get_hasher()
+            md5.update(b''.join(getattr(f, field) for f in self._all_items()))
             digest = md5.digest()
             setattr(self, field, digest)
 
     @property
     def subfolders(self):
         if self._subfolders is None:
-            subfolders = [p for p in self.path.listdir() if not p.islink() and p.isdir()]
-            self._subfolders = [self.__class__(p) for p in subfolders]
+            self._list_items()
         return self._subfolders
 
     @classmethod
@@ -241,6 +381,89 @@ def get_file(path, fileclasses=[File]):
         if fileclass.can_handle(path):
             return fileclass(path)
 
+class _DirEntryPath(Path):
+    # A Path that answers islink(), isdir() and isfile() from the os.DirEntry it was listed with,
+    # which doesn't need a stat() call on most platforms. It's only given to can_handle(): File
+    # instances get a plain Path.
+    def __new__(cls, path, entry):
+        result = tuple.__new__(cls, path)
+        result.entry = entry
+        return result
+
+    def isdir(self):
+        try:
+            return self.entry.is_dir()
+        except OSError:
+            return False
+
+    def isfile(self):
+        try:
+            return self.entry.is_file()
+        except OSError:
+            return False
+
+    def islink(self):
+        try:
+            return self.entry.is_symlink()
+        except OSError:
+            return False
+
+
+def get_files_and_folders(path, fileclasses=[File], read_stats=False, size_threshold=0, snapshot=None):
+    """Returns ``(files, folder_paths)`` for the items directly contained in ``path``.
+
+    ``files`` is a list of :class:`File` for each item one of ``fileclasses`` can handle (see
+    :func:`get_file`) and ``folder_paths`` is a list of the paths of other subfolders, symlinks
+    excluded. A folder handled by a file class (a bundle) is only in ``files``.
+
+    ``path`` is listed only once. With ``os.scandir()``, the type of items comes from the listing
+    and most of them don't need any more system call.
+
+    :param Path path: path to list
+    :param fileclasses: List of candidate :class:`File` classes
+    :param bool read_stats: if true, the size, mtime, dev and inode of files are set from the
+                            ``stat()`` of their ``os.DirEntry``, which is free on Windows.
+    :param int size_threshold: if set, files smaller than that are skipped, without creating
+                               their :class:`File`. Implies ``read_stats``. Folders (bundles)
+                               aren't checked, their size is only known once they're listed.
+    :param snapshot: if set, a :class:`core.cache.FolderSnapshot` that ``path`` is listed through.
+                     Its stored listing is used if ``path`` didn't change.
+    :raises EnvironmentError: if ``path`` can't be listed.
+    """
+    files = []
+    folder_paths = []
+    read_stats = read_stats or size_threshold
+    if snapshot is not None:
+        items = [(path[entry.name], entry) for entry in snapshot.list_folder(path)]
+    elif scandir is not None:
+        items = [(path[entry.name], entry) for entry in scandir(str(path))]
+    else:
+        items = [(item_path, None) for item_path in path.listdir()]
+    for item_path, entry in items:
+        probe_path = item_path if entry is None else _DirEntryPath(item_path, entry)
+        for fileclass in fileclasses:
+            if fileclass.can_handle(probe_path):
+                stats = None
+                if read_stats and not issubclass(fileclass, Folder):
+                    try:
+                        stats = entry.stat() if entry is not None else item_path.stat()
+                    except OSError:
+                        # The file was probably deleted. Without a threshold, we let the File
+                        # report the error when its info is read.
+                        if size_threshold:
+                            break
+                    if stats is not None and stats.st_size < size_threshold:
+                        break
+                file = fileclass(item_path)
+                if stats is not None:
+                    file._set_stats(stats)
+                files.append(file)
+                break
+        else:
+            if not probe_path.islink() and probe_path.isdir():
+                folder_paths.append(item_path)
+    return files, folder_paths
+
 def get_files(path, fileclasses=[File]):
     """Returns a list of :class:`File` for each file contained in ``path``.
 
@@ -249,11 +472,6 @@ def get_files(path, fileclasses=[File]):
     """
     assert all(issubclass(fileclass, File) for fileclass in fileclasses)
     try:
-        result = []
-        for path in path.listdir():
-            file = get_file(path, fileclasses=fileclasses)
-            if file is not None:
-                result.append(file)
-        return result
+        return get_files_and_folders(path, fileclasses=fileclasses)[0]
     except EnvironmentError:
         raise InvalidPath(path)
@@ -17,7 +17,7 @@ from hscommon.conflict import get_conflicted_name
 from hscommon.util import flatten, nonone, FileOrPath, format_size
 from hscommon.trans import tr
 
-from . import engine
+from . import engine, fs
 from .markable import Markable
 
 class Results(Markable):
@@ -242,6 +242,9 @@ class Results(Markable):
                     continue
                 file.words = words.split(',')
                 file.is_ref = file_elem.get('is_ref') == 'y'
+                hash_algorithm = file_elem.get('hash_algorithm')
+                if hash_algorithm in fs.HASH_ALGORITHMS:
+                    file.hash_algorithm = hash_algorithm
                 dupes.append(file)
                 if file_elem.get('marked') == 'y':
                     marked.add(file)
@@ -359,6 +362,10 @@ class Results(Markable):
                 except ValueError: # If there's an invalid character, just skip the file
                     file_elem.set('path', '')
                 file_elem.set('is_ref', ('y' if d.is_ref else 'n'))
+                # Digests aren't saved, but files remember how they were hashed. MD5 is implied.
+                hash_algorithm = getattr(d, 'hash_algorithm', fs.DEFAULT_HASH_ALGORITHM)
+                if hash_algorithm != fs.DEFAULT_HASH_ALGORITHM:
+                    file_elem.set('hash_algorithm', hash_algorithm)
                 file_elem.set('marked', ('y' if self.is_marked(d) else 'n'))
             for match in g.matches:
                 match_elem = ET.SubElement(group_elem, 'match')
@@ -11,10 +11,10 @@ import re
 import os.path as op
 
 from hscommon.jobprogress import job
-from hscommon.util import dedupe, rem_file_ext, get_file_ext
+from hscommon.util import rem_file_ext, get_file_ext
 from hscommon.trans import tr
 
-from . import engine
+from . import engine, fs
 from .ignore import IgnoreList
 
 # It's quite ugly to have scan types from all editions all put in the same class, but because there's
@@ -80,9 +80,24 @@ class Scanner:
                 f.size # pre-read, makes a smoother progress if read here (especially for bundles)
             files = [f for f in files if f.size >= self.size_threshold]
         if self.scan_type in {ScanType.Contents, ScanType.ContentsAudio, ScanType.Folders}:
+            hash_algorithm = self.hash_algorithm
+            if hash_algorithm not in fs.HASH_ALGORITHMS:
+                logging.warning(
+                    "Hash algorithm %r isn't available, using %r", hash_algorithm,
+                    fs.DEFAULT_HASH_ALGORITHM
+                )
+                hash_algorithm = fs.DEFAULT_HASH_ALGORITHM
+            for f in files:
+                f.hash_algorithm = hash_algorithm
             sizeattr = 'audiosize' if self.scan_type == ScanType.ContentsAudio else 'size'
-            return engine.getmatches_by_contents(
-                files, sizeattr, partial=self.scan_type == ScanType.ContentsAudio, j=j
+            # Folders with different structures are told apart before their subtrees are hashed.
+            signatureattr = 'size_signature' if self.scan_type == ScanType.Folders else None
+            return engine.itermatches_by_contents(
+                files, sizeattr, partial=self.scan_type == ScanType.ContentsAudio,
+                thread_count=self.hash_thread_count, cache_path=self.digest_cache_path,
+                cache_roots=self.digest_cache_roots,
+                bytewise=self.bytewise_comparison and self.scan_type != ScanType.Folders,
+                signatureattr=signatureattr, j=j
             )
         else:
             j = j.start_subjob([2, 8])
@@ -90,6 +105,11 @@ class Scanner:
             kw['match_similar_words'] = self.match_similar_words
             kw['weight_words'] = self.word_weighting
             kw['min_match_percentage'] = self.min_match_percentage
+            kw['process_count'] = self.process_count
+            if self.approximate_matching:
+                kw['approximate'] = True
+                kw['lsh_bands'] = self.lsh_bands
+                kw['lsh_rows'] = self.lsh_rows
             if self.scan_type == ScanType.FieldsNoOrder:
                 self.scan_type = ScanType.Fields
                 kw['no_field_order'] = True
@@ -105,7 +125,7 @@ class Scanner:
             for f in j.iter_with_progress(files, tr("Read metadata of %d/%d files")):
                 logging.debug("Reading metadata of {}".format(str(f.path)))
                 f.words = func(f)
-            return engine.getmatches(files, j=j, **kw)
+            return engine.itermatches(files, j=j, **kw)
 
     @staticmethod
     def _key_func(dupe):
@@ -131,14 +151,17 @@ class Scanner:
             f.is_ref = False
         files = remove_dupe_paths(files)
         logging.info("Getting matches. Scan type: %d", self.scan_type)
+        # Matches are filtered and grouped as they're found, so that we don't have to hold all of
+        # them in memory before grouping them.
         matches = self._getmatches(files, j)
-        logging.info('Found %d matches' % len(matches))
-        j.set_progress(100, tr("Removing false matches"))
         # In removing what we call here "false matches", we first want to remove, if we scan by
         # folders, we want to remove folder matches for which the parent is also in a match (they're
         # "duplicated duplicates if you will). Then, we also don't want mixed file kinds if the
         # option isn't enabled, we want matches for which both files exist and, lastly, we don't
         # want matches with both files as ref.
+        if self.scan_type == ScanType.Folders:
+            # We need all matches to know which folders have a parent in a match.
+            matches = list(matches)
         if self.scan_type == ScanType.Folders and matches:
             allpath = {m.first.path for m in matches}
             allpath |= {m.second.path for m in matches}
@@ -152,19 +175,28 @@ class Scanner:
                     last_parent_path = p
             matches = [m for m in matches if m.first.path not in toremove or m.second.path not in toremove]
         if not self.mix_file_kind:
-            matches = [m for m in matches if get_file_ext(m.first.name) == get_file_ext(m.second.name)]
-        matches = [m for m in matches if m.first.path.exists() and m.second.path.exists()]
-        matches = [m for m in matches if not (m.first.is_ref and m.second.is_ref)]
+            matches = (m for m in matches if get_file_ext(m.first.name) == get_file_ext(m.second.name))
+        matches = (m for m in matches if m.first.path.exists() and m.second.path.exists())
+        matches = (m for m in matches if not (m.first.is_ref and m.second.is_ref))
         if self.ignore_list:
-            j = j.start_subjob(2)
-            iter_matches = j.iter_with_progress(matches, tr("Processed %d/%d matches against the ignore list"))
-            matches = [
-                m for m in iter_matches
+            matches = (
+                m for m in matches
                 if not self.ignore_list.AreIgnored(str(m.first.path), str(m.second.path))
-            ]
+            )
+        matched_files = set()
+        match_count = 0
+
+        def record_matches(matches):
+            nonlocal match_count
+            for m in matches:
+                match_count += 1
+                matched_files.add(m.first)
+                matched_files.add(m.second)
+                yield m
+
         logging.info('Grouping matches')
-        groups = engine.get_groups(matches, j)
-        matched_files = dedupe([m.first for m in matches] + [m.second for m in matches])
+        groups = engine.get_groups(record_matches(matches), j)
+        logging.info('Grouped %d matches' % match_count)
         if self.scan_type in {ScanType.Filename, ScanType.Fields, ScanType.FieldsNoOrder, ScanType.Tag}:
             self.discarded_file_count = len(matched_files) - sum(len(g) for g in groups)
         else:
@@ -186,9 +218,18 @@ class Scanner:
             g.prioritize(self._key_func, self._tie_breaker)
         return groups
 
+    approximate_matching = False
+    bytewise_comparison = False
+    digest_cache_path = None
+    digest_cache_roots = None
+    hash_algorithm = fs.DEFAULT_HASH_ALGORITHM
+    hash_thread_count = engine.HASH_THREAD_COUNT
+    lsh_bands = engine.LSH_BANDS
+    lsh_rows = engine.LSH_ROWS
     match_similar_words = False
     min_match_percentage = 80
     mix_file_kind = True
+    process_count = engine.PROCESS_COUNT
     scan_type = ScanType.Filename
     scanned_tags = {'artist', 'title'}
     size_threshold = 0
@@ -112,6 +112,21 @@ class TestCaseDupeGuru:
         app.start_scanning()
         eq_(len(app.results.groups), 0)
 
+    @mark.skipif("not hasattr(os, 'link')")
+    def test_hardlink_matches(self, tmpdir):
+        tmppath = Path(str(tmpdir))
+        tmppath['myfile'].open('w').write('foo')
+        os.link(str(tmppath['myfile']), str(tmppath['hardlink']))
+        app = TestApp().app
+        app.directories.add_path(tmppath)
+        app.scanner.scan_type = ScanType.Contents
+        files = list(app.directories.get_files())
+        eq_(len(app._remove_hardlink_dupes(files)), 1)
+        # Without the ignore_hardlink_matches option, links match, but they're only read once.
+        groups = app.scanner.get_dupe_groups(files)
+        eq_(len(groups), 1)
+        eq_(len(groups[0]), 2)
+
     def test_rename_when_nothing_is_selected(self):
         # Issue #140
         # It's possible that rename operation has its selected row swept off from under it, thus
@@ -63,6 +63,7 @@ class DupeGuru(DupeGuruBase):
     def __init__(self):
         DupeGuruBase.__init__(self, DupeGuruView())
         self.appdata = '/tmp'
+        self.scanner.digest_cache_path = None
 
     def _prioritization_categories(self):
         return prioritize.all_categories()
@@ -78,7 +79,10 @@ class NamedObject:
             folder = 'basepath'
         self._folder = Path(folder)
         self.size = size
+        self.dev = self.inode = 0
+        self.md5head = name
         self.md5partial = name
+        self.md5samples = name
         self.md5 = name
         if with_words:
             self.words = getwords(name)
@@ -0,0 +1,253 @@
+# Copyright 2015 Hardcoded Software (http://www.hardcoded.net)
+#
+# This software is licensed under the "GPLv3" License as described in the "LICENSE" file,
+# which should be included with this package. The terms are also available at
+# http://www.gnu.org/licenses/gpl-3.0.html
+
+import hashlib
+import os
+
+from hscommon.path import Path
+from hscommon.testutil import eq_
+
+from .. import fs, engine
+from ..cache import DigestCache, FolderSnapshot
+
+def create_file(path, data):
+    with path.open('wb') as fp:
+        fp.write(data)
+    return fs.File(path)
+
+def test_save_then_load(tmpdir):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    c = DigestCache()
+    missing = c.load([f], 'md5')
+    eq_(missing, [(f, missing[0][1])])
+    c.save(missing, 'md5')
+    eq_(len(c), 1)
+    f = fs.File(p['foo'])
+    eq_(c.load([f], 'md5'), [])
+    eq_(f.md5, hashlib.md5(b'foo').digest())
+    eq_((c.hit_count, c.miss_count), (1, 1))
+
+def test_fields_are_cached_separately(tmpdir):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    c = DigestCache()
+    c.save(c.load([f], 'md5partial'), 'md5partial')
+    eq_(len(c.load([fs.File(p['foo'])], 'md5')), 1)
+
+def test_hash_algorithm_is_part_of_the_key(tmpdir):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    c = DigestCache()
+    c.save(c.load([f], 'md5'), 'md5')
+    f = fs.File(p['foo'])
+    f.hash_algorithm = 'blake2b'
+    eq_(len(c.load([f], 'md5')), 1)
+
+def test_sampling_parameters_are_part_of_the_key(tmpdir, monkeypatch):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    c = DigestCache()
+    c.save(c.load([f], 'md5samples'), 'md5samples')
+    eq_(c.load([fs.File(p['foo'])], 'md5samples'), [])
+    monkeypatch.setattr(fs, 'SAMPLE_SIZE', fs.SAMPLE_SIZE * 2)
+    eq_(len(c.load([fs.File(p['foo'])], 'md5samples')), 1)
+
+def test_modified_file_is_read_again(tmpdir):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    c = DigestCache()
+    c.save(c.load([f], 'md5'), 'md5')
+    stats = p['foo'].stat()
+    create_file(p['foo'], b'bar')
+    os.utime(str(p['foo']), ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+    f = fs.File(p['foo'])
+    eq_(len(c.load([f], 'md5')), 1)
+    eq_(f.md5, hashlib.md5(b'bar').digest())
+
+def test_folders_arent_cached(tmpdir):
+    # A folder's mtime doesn't change when the contents of its files do.
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    create_file(p['dir']['foo'], b'foo')
+    c = DigestCache()
+    eq_(c.load([fs.Folder(p['dir'])], 'md5'), [])
+    eq_(c.miss_count, 0)
+
+def test_persistence(tmpdir):
+    p = Path(str(tmpdir))
+    f = create_file(p['foo'], b'foo')
+    dbname = str(p['digests.db'])
+    c = DigestCache(dbname)
+    c.save(c.load([f], 'md5'), 'md5')
+    c.close()
+    c = DigestCache(dbname)
+    eq_(c.load([fs.File(p['foo'])], 'md5'), [])
+
+def test_purge_outdated(tmpdir):
+    p = Path(str(tmpdir))
+    files = [create_file(p['file%d' % i], b'foo') for i in range(3)]
+    c = DigestCache()
+    c.save(c.load(files, 'md5'), 'md5')
+    p['file0'].remove()
+    p['file1'].remove()
+    create_file(p['file1'], b'replaced')
+    c.purge_outdated()
+    eq_(len(c), 1)
+    eq_(c.load([fs.File(p['file2'])], 'md5'), [])
+
+def test_purge_outdated_under_roots(tmpdir):
+    # Records of files outside the scanned folders are neither checked nor deleted.
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    p['dirbis'].mkdir()
+    files = [create_file(p['dir']['foo'], b'foo'), create_file(p['dirbis']['foo'], b'foo')]
+    c = DigestCache()
+    c.save(c.load(files, 'md5'), 'md5')
+    p['dir']['foo'].remove()
+    p['dirbis']['foo'].remove()
+    c.purge_outdated([p['dir']])
+    eq_(len(c), 1)
+    c.purge_outdated([])
+    eq_(len(c), 1)
+    c.purge_outdated()
+    eq_(len(c), 0)
+
+def test_purge_outdated_in_batches(tmpdir, monkeypatch):
+    monkeypatch.setattr('core.cache.PURGE_BATCH_SIZE', 2)
+    p = Path(str(tmpdir))
+    files = [create_file(p['file%d' % i], b'foo') for i in range(5)]
+    c = DigestCache()
+    c.save(c.load(files, 'md5'), 'md5')
+    for i in range(4):
+        p['file%d' % i].remove()
+    c.purge_outdated()
+    eq_(len(c), 1)
+
+def test_corrupted_db(tmpdir):
+    dbname = str(tmpdir.join('digests.db'))
+    with open(dbname, 'w') as fp:
+        fp.write('invalid sqlite content')
+    c = DigestCache(dbname) # no exception
+    eq_(len(c), 0)
+
+def test_log_hit_ratio(tmpdir, monkeypatch):
+    logged = []
+    monkeypatch.setattr('logging.info', lambda msg, *args: logged.append(msg % args))
+    p = Path(str(tmpdir))
+    c = DigestCache()
+    c.save(c.load([create_file(p['foo'], b'foo')], 'md5'), 'md5')
+    c.load([fs.File(p['foo'])], 'md5')
+    c.log_hit_ratio()
+    eq_(logged, ["Digest cache: 1 hits out of 2 lookups (50.0%)"])
+
+def test_contents_scan_uses_cache(tmpdir):
+    p = Path(str(tmpdir))
+    dbname = str(p['digests.db'])
+    create_file(p['foo'], b'foo')
+    create_file(p['bar'], b'bar')
+    def getfiles():
+        files = [fs.File(p['foo']), fs.File(p['bar'])]
+        for f in files:
+            f.is_ref = False
+        return files
+    eq_(engine.getmatches_by_contents(getfiles(), cache_path=dbname), [])
+    # The cached digests of foo are used as long as its size and mtime don't change.
+    stats = p['foo'].stat()
+    create_file(p['foo'], b'bar')
+    os.utime(str(p['foo']), ns=(stats.st_atime_ns, stats.st_mtime_ns))
+    eq_(engine.getmatches_by_contents(getfiles(), cache_path=dbname), [])
+    os.utime(str(p['foo']), ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+    eq_(len(engine.getmatches_by_contents(getfiles(), cache_path=dbname)), 1)
+
+def test_snapshot_reuses_unchanged_folder(tmpdir, monkeypatch):
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    create_file(p['dir']['foo'], b'foo')
+    p['dir']['sub'].mkdir()
+    folder_stats = p['dir'].stat()
+    old_mtime_ns = folder_stats.st_mtime_ns - 10 * 10**9
+    os.utime(str(p['dir']), ns=(folder_stats.st_atime_ns, old_mtime_ns))
+    dbname = str(p['snapshot.db'])
+    s = FolderSnapshot(dbname)
+    files, folders = fs.get_files_and_folders(p['dir'], read_stats=True, snapshot=s)
+    s.save()
+    s.close()
+    monkeypatch.setattr(fs, 'scandir', None)
+    monkeypatch.setattr(Path, 'listdir', lambda path: 1/0)
+    s = FolderSnapshot(dbname)
+    cached_files, cached_folders = fs.get_files_and_folders(p['dir'], read_stats=True, snapshot=s)
+    eq_((s.hit_count, s.miss_count), (1, 0))
+    eq_([f.path for f in cached_files], [f.path for f in files])
+    eq_(cached_folders, folders)
+    eq_((cached_files[0].size, cached_files[0].mtime, cached_files[0].inode),
+        (files[0].size, files[0].mtime, files[0].inode))
+
+def test_snapshot_lists_changed_folder_again(tmpdir):
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    create_file(p['dir']['foo'], b'foo')
+    folder_stats = p['dir'].stat()
+    os.utime(str(p['dir']), ns=(folder_stats.st_atime_ns, folder_stats.st_mtime_ns - 10 * 10**9))
+    s = FolderSnapshot()
+    fs.get_files_and_folders(p['dir'], snapshot=s)
+    s.save()
+    create_file(p['dir']['bar'], b'bar')
+    files, folders = fs.get_files_and_folders(p['dir'], snapshot=s)
+    eq_(sorted(f.name for f in files), ['bar', 'foo'])
+    eq_((s.hit_count, s.miss_count), (0, 2))
+
+def test_snapshot_doesnt_trust_recently_modified_folder(tmpdir):
+    # The folder could still change within the resolution of its mtime.
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    create_file(p['dir']['foo'], b'foo')
+    s = FolderSnapshot()
+    fs.get_files_and_folders(p['dir'], snapshot=s)
+    s.save()
+    fs.get_files_and_folders(p['dir'], snapshot=s)
+    eq_(s.hit_count, 0)
+
+def test_snapshot_corrupted_db(tmpdir):
+    dbname = str(tmpdir.join('snapshot.db'))
+    with open(dbname, 'w') as fp:
+        fp.write('invalid sqlite content')
+    s = FolderSnapshot(dbname) # no exception
+    eq_(len(s), 0)
+
+def test_snapshot_doesnt_stat_files_without_read_stats(tmpdir):
+    # Like the walk without a snapshot, files are only stat()ed when their stats are read.
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    create_file(p['dir']['foo'], b'foo')
+    s = FolderSnapshot()
+    fs.get_files_and_folders(p['dir'], snapshot=s)
+    s.save()
+    eq_(s.con.execute("select name, size from entries").fetchall(), [('foo', None)])
+    fs.get_files_and_folders(p['dir'], read_stats=True, snapshot=s)
+    s.save()
+    eq_(s.con.execute("select name, size from entries").fetchall(), [('foo', 3)])
+
+def test_snapshot_purge_unvisited(tmpdir):
+    p = Path(str(tmpdir))
+    for name in ['dir', 'other']:
+        p[name].mkdir()
+        p[name]['sub'].mkdir()
+    dbname = str(p['snapshot.db'])
+    s = FolderSnapshot(dbname)
+    for path in [p['dir'], p['dir']['sub'], p['other'], p['other']['sub']]:
+        s.list_folder(path)
+    s.save()
+    s.close()
+    p['dir']['sub'].rmdir()
+    s = FolderSnapshot(dbname)
+    s.list_folder(p['dir'])
+    s.purge_unvisited([p['dir']])
+    # Folders outside the roots are kept, they weren't walked.
+    expected = sorted(str(path) for path in [p['dir'], p['other'], p['other']['sub']])
+    eq_(sorted(row[0] for row in s.con.execute("select path from folders")), expected)
+    folders = set(row[0] for row in s.con.execute("select folder from entries"))
+    eq_(folders, {str(p['dir']), str(p['other'])})
@@ -10,11 +10,16 @@ import os
 import time
 import tempfile
 import shutil
+import sqlite3 as sqlite
+import threading
 
 from pytest import raises
+from hscommon.jobprogress import job
 from hscommon.path import Path
 from hscommon.testutil import eq_
+from hscommon.util import first
 
+from .. import fs
 from ..directories import *
 
 def create_fake_fs(rootpath):
@@ -296,3 +301,215 @@ def test_default_path_state_override(tmpdir):
     eq_(d.get_state(p1['foobar']), DirectoryState.Normal)
     eq_(len(list(d.get_files())), 2)
 
+
+def test_get_files_doesnt_recurse_into_bundles(tmpdir):
+    class Bundle(fs.Folder):
+        @classmethod
+        def can_handle(cls, path):
+            return fs.Folder.can_handle(path) and path.name.endswith('.bundle')
+
+    p = Path(str(tmpdir))
+    p['foo.bundle'].mkdir()
+    p['foo.bundle']['inside'].open('w').close()
+    p['dir'].mkdir()
+    p['dir']['file'].open('w').close()
+    d = Directories(fileclasses=[Bundle, fs.File])
+    d.add_path(p)
+    files = list(d.get_files())
+    eq_(sorted(f.path for f in files), [p['dir']['file'], p['foo.bundle']])
+    assert isinstance(first(f for f in files if f.path == p['foo.bundle']), Bundle)
+
+def test_get_files_skips_symlinks(tmpdir):
+    if not hasattr(os, 'symlink'):
+        return
+    p = Path(str(tmpdir))
+    p['dir'].mkdir()
+    p['dir']['file'].open('w').close()
+    os.symlink(str(p['dir']), str(p['dirlink']))
+    os.symlink(str(p['dir']['file']), str(p['filelink']))
+    d = Directories()
+    d.add_path(p)
+    eq_([f.path for f in d.get_files()], [p['dir']['file']])
+
+def test_get_files_without_scandir(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs, 'scandir', None)
+    d = Directories()
+    p = create_fake_fs(Path(str(tmpdir)))
+    d.add_path(p)
+    d.set_state(p['dir1'], DirectoryState.Reference)
+    d.set_state(p['dir2'], DirectoryState.Excluded)
+    files = list(d.get_files())
+    eq_(len(files), 5)
+    eq_([f.path for f in files if f.is_ref], [p['dir1']['file1.test']])
+
+def test_get_files_size_threshold(tmpdir):
+    d = Directories()
+    p = create_fake_fs(Path(str(tmpdir)))
+    d.add_path(p)
+    eq_(len(list(d.get_files(size_threshold=2))), 4)
+    # The threshold only applies to that walk
+    eq_(len(list(d.get_files())), 6)
+
+def test_get_files_with_threads(tmpdir):
+    # Files come in the same order as in a walk without threads, and states are respected.
+    p = Path(str(tmpdir))
+    p['a'].mkdir()
+    p['b'].mkdir()
+    roots = [create_fake_fs(p['a']), create_fake_fs(p['b'])]
+    for root in roots:
+        root['dir1']['sub'].mkdir()
+        root['dir1']['sub']['file4.test'].open('w').close()
+    d = Directories()
+    for root in roots:
+        d.add_path(root)
+    d.set_state(roots[0]['dir1'], DirectoryState.Reference)
+    d.set_state(roots[1]['dir2'], DirectoryState.Excluded)
+    expected = [(f.path, f.is_ref) for f in d.get_files()]
+    eq_(len(expected), 13)
+    eq_([(f.path, f.is_ref) for f in d.get_files(thread_count=4)], expected)
+
+def test_get_files_with_threads_small_lookahead(tmpdir, monkeypatch):
+    # When the look-ahead is full, the walk lists the folder it needs itself.
+    monkeypatch.setattr('core.directories.WALK_LOOKAHEAD', 1)
+    p = create_fake_fs(Path(str(tmpdir)))
+    p['dir1']['sub'].mkdir()
+    p['dir1']['sub']['file4.test'].open('w').close()
+    d = Directories()
+    d.add_path(p)
+    expected = [f.path for f in d.get_files()]
+    eq_([f.path for f in d.get_files(thread_count=2)], expected)
+
+def test_get_files_with_threads_cancelled(tmpdir, monkeypatch):
+    # The walk stops while it waits on a folder that is still being listed.
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = Directories()
+    d.add_path(p)
+    listed = threading.Event()
+    def list_folder(path, **kwargs):
+        if path != p:
+            listed.wait()
+        return fs_get_files_and_folders(path, **kwargs)
+
+    fs_get_files_and_folders = fs.get_files_and_folders
+    monkeypatch.setattr(fs, 'get_files_and_folders', list_folder)
+    cancelled = []
+    j = job.Job(1, lambda progress, desc='': not cancelled)
+    yielded = []
+    with raises(job.JobCancelled):
+        for file in d.get_files(j, thread_count=4):
+            yielded.append(file)
+            cancelled.append(True)
+    listed.set()
+    # Only the files of the root, listed before the cancellation, were yielded.
+    eq_(sorted(f.path for f in yielded), [p['file1.test'], p['file2.test'], p['file3.test']])
+
+def test_get_files_in_excluded_folder_with_included_subfolder(tmpdir, monkeypatch):
+    p = Path(str(tmpdir))
+    p['dir']['sub']['subsub'].makedirs()
+    p['dir']['file'].open('w').close()
+    p['dir']['sub']['subsub']['file'].open('w').close()
+    d = Directories()
+    d.add_path(p)
+    d.set_state(p['dir'], DirectoryState.Excluded)
+    d.set_state(p['dir']['sub']['subsub'], DirectoryState.Reference)
+    eq_([f.path for f in d.get_files()], [p['dir']['sub']['subsub']['file']])
+    # Once the subfolder is excluded too, the excluded folder isn't listed at all.
+    d.set_state(p['dir']['sub']['subsub'], DirectoryState.Excluded)
+    listed = []
+    def list_folder(path, **kwargs):
+        listed.append(path)
+        return fs_get_files_and_folders(path, **kwargs)
+
+    fs_get_files_and_folders = fs.get_files_and_folders
+    monkeypatch.setattr(fs, 'get_files_and_folders', list_folder)
+    eq_(list(d.get_files()), [])
+    eq_(listed, [p])
+
+def test_set_state_removes_states_under_path():
+    d = Directories()
+    p = testpath['fs']
+    d.add_path(p)
+    d.set_state(p['dir1'], DirectoryState.Excluded)
+    d.set_state(p['dir2'], DirectoryState.Reference)
+    eq_(len(d.states), 2)
+    d.set_state(p, DirectoryState.Excluded)
+    eq_(d.states, {p: DirectoryState.Excluded})
+    eq_(d.get_state(p['dir2']), DirectoryState.Excluded)
+
+def test_get_files_with_snapshot(tmpdir):
+    p = Path(str(tmpdir))
+    root = create_fake_fs(p)
+    d = Directories()
+    d.add_path(root)
+    d.snapshot_path = str(p['snapshot.db'])
+    expected = [f.path for f in d.get_files()]
+    eq_([f.path for f in d.get_files(read_stats=True, thread_count=4)], expected)
+    # Stats come from the snapshot
+    eq_(sorted(f.size for f in d.get_files(read_stats=True)), [1, 1, 2, 2, 3, 3])
+
+def test_get_files_with_threads_and_overridden_get_files(tmpdir):
+    # Subclasses override _get_files() with two arguments to handle virtual roots, which aren't
+    # listed ahead.
+    VIRTUAL_PATH = Path('Virtual Library')
+
+    class MyDirectories(Directories):
+        def _get_files(self, from_path, j):
+            if from_path == VIRTUAL_PATH:
+                return []
+            return Directories._get_files(self, from_path, j)
+
+    p = create_fake_fs(Path(str(tmpdir)))
+    d = MyDirectories()
+    d.add_path(p)
+    d._dirs.append(VIRTUAL_PATH)
+    expected = [f.path for f in d.get_files()]
+    eq_(len(expected), 6)
+    eq_([f.path for f in d.get_files(thread_count=4)], expected)
+
+def test_set_state_keeps_state_tree_counts(tmpdir):
+    # Under an excluded (hidden) folder, setting a state on a folder and then on its parent used
+    # to leave stale counts in the state tree, and the excluded folder was then wrongly pruned.
+    p = Path(str(tmpdir))
+    a = p['.hidden']['a']
+    a.makedirs()
+    a['f'].open('w').close()
+    d = Directories()
+    d.add_path(p)
+    d.set_state(a['b'], DirectoryState.Normal)
+    d.set_state(a, DirectoryState.Reference)
+    d.set_state(a['c'], DirectoryState.Normal)
+    d.set_state(a, DirectoryState.Normal)
+    eq_([f.path for f in d.get_files()], [a['f']])
+    # The counts are the same as in a tree built from scratch with the same states.
+    rebuilt = Directories()
+    for path, state in d.states.items():
+        rebuilt._state_tree.set(path, state)
+
+    def counts(node, path=()):
+        yield path, node.included_count
+        for name, child in node.children.items():
+            yield from counts(child, path + (name, ))
+
+    eq_(dict(c for c in counts(d._state_tree) if c[1]), dict(c for c in counts(rebuilt._state_tree) if c[1]))
+
+def test_get_files_with_snapshot_purges_removed_folders(tmpdir):
+    p = Path(str(tmpdir))
+    root = create_fake_fs(p)
+    d = Directories()
+    d.add_path(root)
+    d.snapshot_path = str(p['snapshot.db'])
+
+    def snapshot_folders():
+        con = sqlite.connect(d.snapshot_path)
+        result = sorted(row[0] for row in con.execute("select path from folders"))
+        con.close()
+        return result
+
+    list(d.get_files())
+    eq_(len(snapshot_folders()), 4)
+    # An interrupted walk, like has_any_file(), doesn't purge the folders it didn't go through.
+    d.set_state(root['dir2'], DirectoryState.Excluded)
+    assert d.has_any_file()
+    eq_(len(snapshot_folders()), 4)
+    list(d.get_files())
+    eq_(snapshot_folders(), sorted(str(path) for path in [root, root['dir1'], root['dir3']]))
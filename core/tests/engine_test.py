@@ -6,14 +6,19 @@
 # which should be included with this package. The terms are also available at
 # http://www.gnu.org/licenses/gpl-3.0.html
 
+import difflib
+import itertools
 import sys
 
+from pytest import raises
+
 from hscommon.jobprogress import job
+from hscommon.path import Path
 from hscommon.util import first
 from hscommon.testutil import eq_, log_calls
 
 from .base import NamedObject
-from .. import engine
+from .. import engine, fs
 from ..engine import *
 
 no = NamedObject
@@ -67,6 +72,27 @@ class TestCasegetwords:
     def test_decompose_unicode(self):
         eq_(getwords('foo\xe9bar'), ['fooebar'])
 
+    def test_other_whitespace_isnt_a_separator(self):
+        eq_(['foo\tbar', 'baz'], getwords("foo\tbar baz"))
+
+    def test_result_can_be_modified(self):
+        # Results are cached, but we get a new list every time.
+        words = getwords('foo bar')
+        words.append('baz')
+        eq_(['foo', 'bar'], getwords('foo bar'))
+
+
+class TestCasegetwords_multiple:
+    def test_same_as_getwords(self):
+        strings = ["a b c d", " a  b  c d ", "a-b_c&d+e(f)g;h\\i[j]k{l}m", "a'e\u0301c", '', 'FOO BAR']
+        eq_([getwords(s) for s in strings], getwords_multiple(strings))
+
+    def test_empty(self):
+        eq_([], getwords_multiple([]))
+
+    def test_nul_char_in_strings(self):
+        eq_([['foobar'], ['baz']], getwords_multiple(['foo\0bar', 'baz']))
+
 
 class TestCasegetfields:
     def test_simple(self):
@@ -112,6 +138,11 @@ class TestCaseWordCompare:
         #if a word occurs twice in first, but once in second, we want the word to be only counted once
         eq_(89, compare(['a', 'b', 'c', 'd', 'a'], ['d', 'b', 'c', 'a']))
 
+    def test_word_occurs_twice_in_both(self):
+        eq_(67, compare(['a', 'a', 'b'], ['a', 'a', 'c']))
+        eq_(99, compare(['a', 'a', 'b'], ['a', 'b', 'a']))
+        eq_(100, compare(['a', 'a', 'b'], ['a', 'a', 'b']))
+
     def test_uses_copy_of_lists(self):
         first = ['foo', 'bar']
         second = ['bar', 'bleh']
@@ -181,6 +212,40 @@ class TestCaseWordCompareWithFields:
         eq_([['c','d','f'],['a','b']],second)
 
 
+class TestCaseVocabulary:
+    def test_intern_words(self):
+        v = Vocabulary()
+        eq_((0, 1, 0), v.intern_words(['foo', 'bar', 'foo']))
+        eq_((1, 2), v.intern_words(['bar', 'baz']))
+        eq_(['foo', 'bar', 'baz'], v.words)
+
+    def test_intern_fields(self):
+        v = Vocabulary()
+        eq_(((0, 1), (2, )), v.intern_words([['foo', 'bar'], ['baz']]))
+
+    def test_compare_same_as_words(self):
+        # Comparing interned words gives the same results as comparing the words themselves.
+        v = Vocabulary()
+        pairs = [
+            (['a', 'b', 'c', 'd'], ['a', 'b', 'c']),
+            (['a', 'b', 'c', 'd'], ['d', 'b', 'c', 'a']),
+            (['a', 'b', 'c', 'd', 'a'], ['d', 'b', 'c', 'a']),
+            (['a', 'a', 'b'], ['b', 'a', 'a']),
+            (['foo', 'bar'], ['bar', 'bleh']),
+            (['the', 'white', 'stripes'], ['the', 'whites', 'stripe']),
+            ([['a', 'b'], ['c', 'd', 'e']], [['c', 'd', 'f'], ['a', 'b']]),
+        ]
+        flagsets = [(), (WEIGHT_WORDS, ), (MATCH_SIMILAR_WORDS, ), (NO_FIELD_ORDER, )]
+        for first, second in pairs:
+            for flags in flagsets:
+                expected = compare(first, second, flags)
+                eq_(expected, v.compare(v.intern_words(first), v.intern_words(second), flags))
+
+    def test_compare_empty(self):
+        v = Vocabulary()
+        eq_(0, v.compare((), v.intern_words(['foo'])))
+
+
 class TestCasebuild_word_dict:
     def test_with_standard_words(self):
         l = [NamedObject('foo bar',True)]
@@ -243,6 +308,40 @@ class TestCasemerge_similar_words:
         eq_(1,len(d))
         eq_(3,len(d['foobar']))
 
+    def test_with_index(self):
+        d = {
+            'foobar':set([1]),
+            'foobar1':set([2]),
+            'bleh':set([3]),
+        }
+        merge_similar_words(d, SimilarWordIndex(['foobar', 'foobar1', 'bleh', 'foobar2']))
+        eq_(d, {'foobar': set([1, 2]), 'bleh': set([3])})
+
+
+class TestCaseSimilarWordIndex:
+    WORDS = ['foobar', 'foobars', 'foobaz', 'fobar', 'barfoo', 'foo', 'bar', 'stripes', 'stripe', 'a']
+
+    def test_same_as_difflib(self):
+        index = SimilarWordIndex(self.WORDS)
+        for word in self.WORDS + ['foobarz', 'strip', 'b', 'zzzzzz']:
+            for cutoff in (0.5, 0.6, 0.8, 0.9):
+                expected = difflib.get_close_matches(word, self.WORDS, 5, cutoff)
+                eq_(index.get_close_matches(word, 5, cutoff), expected)
+
+    def test_possibilities(self):
+        index = SimilarWordIndex(self.WORDS)
+        eq_(index.get_close_matches('foobar', 3, 0.8, {'fobar', 'foobaz'}), ['fobar', 'foobaz'])
+
+    def test_get_ratios(self):
+        index = SimilarWordIndex(self.WORDS)
+        eq_(index.get_ratios('stripes', 0.8), {'stripes': 1.0, 'stripe': 12 / 13})
+
+    def test_add_twice(self):
+        index = SimilarWordIndex(['foo', 'foo'])
+        index.add('foo')
+        eq_(len(index), 1)
+        eq_(index.get_close_matches('foo'), ['foo'])
+
 
 
 class TestCasereduce_common_words:
@@ -466,27 +565,300 @@ class TestCaseGetMatches:
         r = getmatches(l, min_match_percentage=50)
         eq_(1,len(r)) #Only "foo bar" / "bar bleh" should match
 
+    def test_pairs_sharing_many_words_are_compared_once(self, monkeypatch):
+        monkeypatch.setattr(engine.Vocabulary, 'compare', log_calls(engine.Vocabulary.compare))
+        l = [NamedObject("foo bar baz"), NamedObject("baz bar foo"), NamedObject("foo bar bleh")]
+        r = getmatches(l)
+        eq_(len(engine.Vocabulary.compare.calls), 3)
+        eq_(len(r), 3)
+
+    def test_min_match_percentage_doesnt_compare_hopeless_pairs(self, monkeypatch):
+        # Word counts are too far apart for "a b c d" / "a" to reach 80%.
+        monkeypatch.setattr(engine.Vocabulary, 'compare', log_calls(engine.Vocabulary.compare))
+        l = [NamedObject("a b c d"), NamedObject("a"), NamedObject("a b c e")]
+        r = getmatches(l, min_match_percentage=70)
+        eq_(len(engine.Vocabulary.compare.calls), 1)
+        eq_(len(r), 1)
+        eq_(r[0].percentage, 75)
+
+    def test_min_match_percentage_same_as_without_pruning(self):
+        # Pruning pairs that can't match must not change the results.
+        def pairs(matches):
+            return {(frozenset([m.first, m.second]), m.percentage) for m in matches}
+
+        words = ["foo", "bar", "bleh", "a", "longerword", "baz", "x"]
+        l = [NamedObject(' '.join(words[i:i+k])) for k in range(1, 5) for i in range(len(words) - k + 1)]
+        for weight_words in (False, True):
+            all_matches = getmatches(l, weight_words=weight_words)
+            for min_match in (1, 30, 50, 67, 80, 100):
+                r = getmatches(l, min_match_percentage=min_match, weight_words=weight_words)
+                eq_(pairs(r), pairs(m for m in all_matches if m.percentage >= min_match))
+
     def test_MemoryError(self, monkeypatch):
         @log_calls
-        def mocked_match(first, second, flags):
-            if len(mocked_match.calls) > 42:
+        def mocked_compare(vocabulary, first, second, flags):
+            if len(mocked_compare.calls) > 42:
                 raise MemoryError()
-            return Match(first, second, 0)
+            return 0
 
         objects = [NamedObject() for i in range(10)] # results in 45 matches
-        monkeypatch.setattr(engine, 'get_match', mocked_match)
+        monkeypatch.setattr(engine.Vocabulary, 'compare', mocked_compare)
         try:
             r = getmatches(objects)
         except MemoryError:
             self.fail('MemorryError must be handled')
         eq_(42, len(r))
 
+    def test_itermatches(self):
+        l = [NamedObject("foo bar"), NamedObject("bar bleh"), NamedObject("a b c foo")]
+        r = itermatches(l, min_match_percentage=50)
+        assert not isinstance(r, list)
+        r = list(r)
+        eq_(len(r), 1)
+        eq_(r[0].percentage, 50)
+
+    def test_approximate(self):
+        l = [no("foo bar baz"), no("bar baz foo"), no("a b c foo"), no("foo bar baz")]
+        r = getmatches(l, min_match_percentage=50, approximate=True)
+        eq_(len(r), 3)
+        for m in r:
+            eq_(m.percentage, compare(m.first.words, m.second.words))
+        eq_(set(l[:2] + l[3:]), {o for m in r for o in [m.first, m.second]})
+
+    def test_approximate_doesnt_ignore_common_words(self):
+        # "foo bar" is too common to be looked at in normal scans.
+        l = [no("foo bar") for i in range(50)] + [no("foo bar a"), no("foo bar b")]
+        r = getmatches(l[48:], min_match_percentage=50, approximate=True, lsh_bands=50, lsh_rows=2)
+        eq_(len(r), 6)
+        r = getmatches(l, min_match_percentage=50, approximate=True, lsh_bands=50, lsh_rows=2)
+        eq_(len(r), 50 * 49 // 2 + 50 * 2 + 1)
+
+    def test_approximate_with_fields(self):
+        o1 = NamedObject("foo bar - foo bleh")
+        o2 = NamedObject("foo bar - bleh bar")
+        o1.words = getfields(o1.name)
+        o2.words = getfields(o2.name)
+        m = getmatches([o1, o2], approximate=True)[0]
+        eq_(m.percentage, 50)
+
+    def test_process_count(self, monkeypatch):
+        monkeypatch.setattr(engine, 'MIN_OBJECTS_FOR_PROCESSES', 0)
+        words = ["foo", "bar", "bleh", "a", "baz", "x"]
+        l = [no(' - '.join(words[i:i+k])) for k in range(1, 4) for i in range(len(words) - k + 1)]
+        l += [no("foo - bar"), no("foo - bar")]
+        for o in l:
+            o.words = getfields(o.name)
+        expected = {(frozenset([m.first, m.second]), m.percentage) for m in getmatches(l)}
+        r = getmatches(l, process_count=2)
+        eq_(len(r), len(expected)) # each pair only once
+        eq_({(frozenset([m.first, m.second]), m.percentage) for m in r}, expected)
+
+    def test_process_count_with_similar_words(self, monkeypatch):
+        monkeypatch.setattr(engine, 'MIN_OBJECTS_FOR_PROCESSES', 0)
+        l = [no("foobar"), no("foobars"), no("bizkit"), no("bizket"), no("foo")]
+        r = getmatches(l, match_similar_words=True, process_count=2)
+        eq_(len(r), 2)
+
+
+class TestCase_get_bucket_tasks:
+    def test_all_pairs_once(self):
+        buckets = [[0, 1, 2, 3, 4], [5, 6], [7], [8, 9, 10]]
+        for task_count in (1, 2, 3, 5, 100):
+            pairs = []
+            for task in engine._get_bucket_tasks(buckets, task_count):
+                for rank, start, stop in task:
+                    bucket = buckets[rank]
+                    pairs += [(bucket[i], other) for i in range(start, stop) for other in bucket[i+1:]]
+            eq_(sorted(pairs), [(a, b) for bucket in buckets for a, b in itertools.combinations(bucket, 2)])
+
+    def test_splits_big_buckets(self):
+        eq_(len(engine._get_bucket_tasks([list(range(100))], 4)), 4)
+
 
 class TestCaseGetMatchesByContents:
     def test_dont_compare_empty_files(self):
         o1, o2 = no(size=0), no(size=0)
         assert not getmatches_by_contents([o1, o2])
 
+    def test_iter(self):
+        o1, o2, o3 = no(size=42), no(size=42), no(size=43)
+        for o in [o1, o2, o3]:
+            o.md5partial = o.md5 = 'foo'
+        r = itermatches_by_contents([o1, o2, o3])
+        assert not isinstance(r, list)
+        r = list(r)
+        eq_(len(r), 1)
+        eq_({r[0].first, r[0].second}, {o1, o2})
+
+    def test_stages_stop_at_first_difference(self):
+        # Files that can be told apart by their md5head don't have their other digests read.
+        o1, o2, o3 = no(size=42), no(size=42), no(size=42)
+        o1.md5head, o2.md5head, o3.md5head = 'foo', 'bar', 'baz'
+        for o in [o1, o2, o3]:
+            del o.md5partial
+            del o.md5
+        eq_(getmatches_by_contents([o1, o2, o3]), [])
+
+    def test_full_digest_only_read_for_remaining_files(self):
+        o1, o2, o3, o4 = [no(size=42) for _ in range(4)]
+        for o in [o1, o2, o3, o4]:
+            o.md5head = o.md5partial = 'foo'
+        o3.md5partial = 'bar'
+        del o3.md5 # o3 has a different md5partial, so its md5 isn't needed
+        o1.md5 = o2.md5 = 'foo'
+        o4.md5 = 'bar'
+        r = getmatches_by_contents([o1, o2, o3, o4])
+        eq_([{m.first, m.second} for m in r], [{o1, o2}])
+
+    def test_samples_are_compared_before_md5(self):
+        o1, o2 = no(size=42), no(size=42)
+        o2.md5samples = 'bar'
+        del o1.md5
+        del o2.md5
+        eq_(getmatches_by_contents([o1, o2]), [])
+
+    def test_partial_doesnt_read_md5(self):
+        o1, o2 = no(size=42), no(size=42)
+        for o in [o1, o2]:
+            del o.md5samples
+            del o.md5
+        eq_(len(getmatches_by_contents([o1, o2], partial=True)), 1)
+
+    def test_threads(self):
+        objects = [no(size=42) for _ in range(10)]
+        for i, o in enumerate(objects):
+            o.md5head = o.md5partial = o.md5 = str(i % 3)
+        r = getmatches_by_contents(objects, thread_count=3)
+        eq_(len(r), 3 + 3 + 6)
+        for m in r:
+            eq_(m.first.md5, m.second.md5)
+
+    def test_threads_job(self):
+        log = []
+        def do_progress(p, d=''):
+            log.append(p)
+            return True
+
+        objects = [no(size=42) for _ in range(10)]
+        getmatches_by_contents(objects, thread_count=3, j=job.Job(1, do_progress))
+        eq_(log[-1], 100)
+
+    def test_threads_bound_pending_reads(self, monkeypatch):
+        monkeypatch.setattr(engine, 'PENDING_READS_PER_THREAD', 2)
+        pending = []
+        max_pending = []
+
+        BaseExecutor = engine.ThreadPoolExecutor
+
+        class CountingExecutor(BaseExecutor):
+            def submit(self, *args, **kwargs):
+                future = BaseExecutor.submit(self, *args, **kwargs)
+                pending.append(future)
+                max_pending.append(sum(1 for f in pending if not f.done()))
+                return future
+
+        monkeypatch.setattr(engine, 'ThreadPoolExecutor', CountingExecutor)
+        objects = [no(size=42) for _ in range(50)]
+        eq_(len(getmatches_by_contents(objects, thread_count=3)), 50 * 49 // 2)
+        assert max(max_pending) <= 3 * 2
+
+    def test_threads_cancel(self):
+        objects = [no(size=42) for _ in range(10)]
+        j = job.Job(1, lambda p, d='': p < 30)
+        with raises(job.JobCancelled):
+            getmatches_by_contents(objects, thread_count=3, j=j)
+
+    def test_dont_compare_ref_files_together(self):
+        o1, o2 = no(size=42), no(size=42)
+        for o in [o1, o2]:
+            o.is_ref = True
+            del o.md5head
+        eq_(getmatches_by_contents([o1, o2]), [])
+
+    def test_links_are_read_once(self):
+        o1, o2, o3 = no(size=42), no(size=42), no(size=42)
+        o1.dev = o2.dev = o3.dev = 1
+        o1.inode = o2.inode = 2
+        o3.inode = 3
+        for attrname in ['md5head', 'md5partial', 'md5']:
+            delattr(o2, attrname)
+            setattr(o1, attrname, 'foo')
+            setattr(o3, attrname, 'foo')
+        r = getmatches_by_contents([o1, o2, o3])
+        eq_(len(r), 3)
+        eq_(o2.md5, 'foo') # shared by o1
+
+    def test_links_alone_in_their_bucket_arent_read(self):
+        o1, o2, o3 = no(size=42), no(size=42), no(size=43)
+        o1.inode = o2.inode = 2
+        for o in [o1, o2]:
+            del o.md5head
+        r = getmatches_by_contents([o1, o2, o3])
+        eq_([{m.first, m.second} for m in r], [{o1, o2}])
+
+    def test_same_inode_on_different_devices_isnt_a_link(self):
+        o1, o2 = no(size=42), no(size=42)
+        o1.inode = o2.inode = 2
+        o1.dev, o2.dev = 1, 2
+        o1.md5 = 'bar'
+        eq_(getmatches_by_contents([o1, o2]), [])
+
+    def test_ref_file_with_non_ref_link(self):
+        o1, o2, o3 = no(size=42), no(size=42), no(size=42)
+        o1.inode = o2.inode = 2
+        o1.is_ref = o3.is_ref = True
+        # o1 and o3 are both refs, but o2 still has to be compared with o3.
+        r = getmatches_by_contents([o1, o3, o2])
+        eq_(len(r), 2)
+        assert all(o2 in m for m in r)
+
+
+class TestCaseGetMatchesByContentsBytewise:
+    def create_files(self, tmpdir, contents):
+        p = Path(str(tmpdir))
+        result = []
+        for i, data in enumerate(contents):
+            with p['file%d' % i].open('wb') as fp:
+                fp.write(data)
+            f = fs.File(p['file%d' % i])
+            f.is_ref = False
+            result.append(f)
+        return result
+
+    def test_splits_on_first_different_block(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(engine, 'COMPARE_BLOCK_SIZE', 4)
+        files = self.create_files(tmpdir, [b'foobarbaz', b'foobarbaz', b'foobazbaz', b'fooooobaz'])
+        r = getmatches_by_contents(files, bytewise=True)
+        eq_([{m.first, m.second} for m in r], [set(files[:2])])
+        # The files weren't hashed
+        assert all(object.__getattribute__(f, 'md5') is fs.NOT_SET for f in files)
+
+    def test_same_contents_with_links(self, tmpdir):
+        files = self.create_files(tmpdir, [b'foo', b'foo'])
+        files.append(fs.File(files[0].path))
+        files[2].is_ref = False
+        eq_(len(getmatches_by_contents(files, bytewise=True)), 3)
+
+    def test_big_buckets_are_hashed(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(engine, 'COMPARE_MAX_FILE_COUNT', 2)
+        files = self.create_files(tmpdir, [b'foo', b'foo', b'foo'])
+        eq_(len(getmatches_by_contents(files, bytewise=True)), 3)
+        assert all(object.__getattribute__(f, 'md5') is not fs.NOT_SET for f in files)
+
+    def test_unreadable_file_is_skipped(self, tmpdir):
+        files = self.create_files(tmpdir, [b'foo', b'foo', b'foo'])
+        # Everything but the contents is read before the file disappears
+        files[0]._read_all_info(['size', 'md5head', 'md5partial'])
+        files[0].path.remove()
+        r = getmatches_by_contents(files, bytewise=True)
+        eq_([{m.first, m.second} for m in r], [set(files[1:])])
+
+    def test_cancel(self, tmpdir):
+        files = self.create_files(tmpdir, [b'foo', b'foo'])
+        j = job.Job(1, lambda p, d='': False)
+        with raises(job.JobCancelled):
+            getmatches_by_contents(files, bytewise=True, j=j)
+
 
 class TestCaseGroup:
     def test_empy(self):
@@ -620,6 +992,30 @@ class TestCaseGroup:
         assert g.get_match_of(NamedObject('',True)) is None
         assert g.get_match_of(g.ref) is None
 
+    def test_get_match_of_keeps_match_order(self):
+        # The match returned is the one that was added, with its files in the same order.
+        o1, o2, o3 = [NamedObject() for _ in range(3)]
+        g = Group()
+        g.add_match(Match(o1, o2, 50))
+        g.add_match(Match(o3, o1, 60))
+        g.add_match(Match(o2, o3, 70))
+        eq_(g.get_match_of(o3), Match(o3, o1, 60))
+        g.switch_ref(o3)
+        eq_(g.get_match_of(o2), Match(o2, o3, 70))
+
+    def test_remove_dupe_without_discarding_matches(self):
+        o1, o2, o3 = [NamedObject() for _ in range(3)]
+        g = Group()
+        for m in [Match(o1, o2, 50), Match(o1, o3, 60), Match(o2, o3, 70)]:
+            g.add_match(m)
+        g.remove_dupe(o3, False)
+        eq_(g.matches, {Match(o1, o2, 50)})
+        eq_(g.percentage, 50)
+
+    def test_no_instance_dict(self):
+        # Results can hold a lot of groups, they have to stay small.
+        assert not hasattr(Group(), '__dict__')
+
     def test_percentage(self):
         #percentage should return the avg percentage in relation to the ref
         m1,m2,m3 = get_match_triangle()
@@ -733,6 +1129,22 @@ class TestCaseget_groups:
         r = get_groups([])
         eq_([],r)
 
+    def test_from_iterator(self):
+        l = [NamedObject("foo"),NamedObject("foo"),NamedObject("foo"),NamedObject("bar"),NamedObject("bar")]
+        r = get_groups(itermatches(l))
+        eq_(sorted(len(g) for g in r), [2, 3])
+
+    def test_MemoryError_while_matching(self):
+        # Matches found before running out of memory are still grouped.
+        l = [NamedObject("foo"),NamedObject("foo"),NamedObject("bar"),NamedObject("bar")]
+        def matches():
+            yield Match(l[0], l[1], 100)
+            yield Match(l[2], l[3], 100)
+            raise MemoryError()
+
+        r = get_groups(matches())
+        eq_(len(r), 2)
+
     def test_simple(self):
         l = [NamedObject("foo bar"),NamedObject("bar bleh")]
         matches = getmatches(l)
@@ -831,3 +1243,33 @@ class TestCaseget_groups:
         assert C in g2
         assert D in g2
 
+    def test_orphans_are_regrouped_over_several_rounds(self):
+        # C and D are orphaned by the (A, B) group and E and F are orphaned by the (C, D) group.
+        A, B, C, D, E, F = [NamedObject() for _ in range(6)]
+        matches = [
+            Match(A, B, 90), Match(A, C, 80), Match(A, D, 80), Match(C, D, 70),
+            Match(C, E, 60), Match(C, F, 60), Match(E, F, 50),
+        ]
+        groups = get_groups(iter(matches))
+        eq_([set(g) for g in groups], [{A, B}, {C, D}, {E, F}])
+
+    def test_same_percentage_keeps_arrival_order(self):
+        A, B, C = [NamedObject() for _ in range(3)]
+        m1 = Match(A, B, 50)
+        m2 = Match(B, C, 50)
+        eq_([set(g) for g in get_groups([m1, m2])], [{A, B}])
+        eq_([set(g) for g in get_groups([m2, m1])], [{B, C}])
+
+    def test_job_with_orphans(self):
+        log = []
+        def do_progress(p, d=''):
+            log.append((p, d))
+            return True
+
+        A, B, C, D = [NamedObject() for _ in range(4)]
+        matches = [Match(A, B, 90), Match(A, C, 80), Match(A, D, 80), Match(C, D, 70)]
+        get_groups(matches, job.Job(1, do_progress))
+        eq_(log[0], (0, "Grouped 0/4 matches"))
+        # The orphan (C, D) match is counted in the second round
+        eq_(log[-1], (100, "Grouped 5/5 matches"))
+
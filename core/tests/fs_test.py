@@ -8,8 +8,10 @@
 
 import hashlib
 
+from pytest import mark
 from hscommon.path import Path
 from hscommon.testutil import eq_
+from hscommon.util import first
 from core.tests.directories_test import create_fake_fs
 
 from .. import fs
@@ -38,6 +40,133 @@ def test_md5_aggregate_subfiles_sorted(tmpdir):
     md5 = hashlib.md5(folder_md51+folder_md52+folder_md53+md54+md55+md56)
     eq_(b.md5, md5.digest())
 
+def test_md5head_covers_the_first_4kb(tmpdir):
+    p = Path(str(tmpdir))
+    data = bytes(range(256)) * 20
+    p['file'].open('wb').write(data)
+    eq_(fs.File(p['file']).md5head, hashlib.md5(data[:0x1000]).digest())
+
+def test_md5_of_file_bigger_than_read_buffer(tmpdir):
+    p = Path(str(tmpdir))
+    data = bytes(range(256)) * (fs.READ_BUFFER_SIZE // 128 + 1)
+    p['file'].open('wb').write(data)
+    eq_(fs.File(p['file']).md5, hashlib.md5(data).digest())
+    # The read buffer is reused from one file to the next
+    p['file2'].open('wb').write(b'foo')
+    eq_(fs.File(p['file2']).md5, hashlib.md5(b'foo').digest())
+
+def test_md5samples_covers_head_middle_and_tail(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs, 'MIN_SAMPLED_SIZE', 0)
+    monkeypatch.setattr(fs, 'SAMPLE_SIZE', 2)
+    p = Path(str(tmpdir))
+    p['file'].open('wb').write(b'abcdefghi')
+    eq_(fs.File(p['file']).md5samples, hashlib.md5(b'abdehi').digest())
+
+def test_md5samples_count_scales_with_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(fs, 'SAMPLE_SPACING', 10)
+    monkeypatch.setattr(fs, 'MAX_SAMPLE_COUNT', 5)
+    p = Path(str(tmpdir))
+    f = fs.File(p['file'])
+    f.size = 2 * 1024 * 1024
+    eq_(len(f._get_md5samples_offsets_and_size()[0]), 5)
+    monkeypatch.setattr(fs, 'SAMPLE_SPACING', 1024 * 1024)
+    eq_(f._get_md5samples_offsets_and_size()[0], [0, f.size // 2 - 0x2000, f.size - 0x4000])
+
+def test_small_files_arent_sampled(tmpdir):
+    p = Path(str(tmpdir))
+    p['file'].open('wb').write(b'foo')
+    eq_(fs.File(p['file']).md5samples, hashlib.md5().digest())
+
+def test_folder_md5samples_aggregates_subfiles(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    b = fs.Folder(p['dir1'])
+    f = fs.File(p['dir1']['file1.test'])
+    eq_(b.md5samples, hashlib.md5(f.md5samples).digest())
+
+def test_folder_lists_each_directory_once(tmpdir, monkeypatch):
+    p = create_fake_fs(Path(str(tmpdir)))
+    listed = []
+    get_files_and_folders = fs.get_files_and_folders
+    monkeypatch.setattr(
+        fs, 'get_files_and_folders', lambda path: listed.append(path) or get_files_and_folders(path)
+    )
+    b = fs.Folder(p)
+    b._read_all_info()
+    for subfolder in b.subfolders:
+        subfolder._read_all_info()
+    eq_(sorted(listed), [p, p['dir1'], p['dir2'], p['dir3']])
+
+def test_folder_size_signature(tmpdir):
+    p = Path(str(tmpdir))
+    for name, sizes in [('foo', [1, 2]), ('bar', [1, 2]), ('baz', [2, 1])]:
+        p[name].mkdir()
+        for i, size in enumerate(sizes):
+            p[name]['file%d' % i].open('wb').write(b'x' * size)
+    foo, bar, baz = [fs.Folder(p[name]) for name in ['foo', 'bar', 'baz']]
+    eq_(foo.size_signature, bar.size_signature)
+    # Same total size and file count, but the sizes aren't in the same order.
+    assert foo.size_signature != baz.size_signature
+    # The signature doesn't read the contents of files.
+    assert all(object.__getattribute__(f, 'md5head') is fs.NOT_SET for f in foo._all_items())
+
+def test_get_files_and_folders(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    files, folder_paths = fs.get_files_and_folders(p)
+    eq_(sorted(f.path for f in files), [p['file1.test'], p['file2.test'], p['file3.test']])
+    eq_(sorted(folder_paths), [p['dir1'], p['dir2'], p['dir3']])
+    # The path of files is a plain Path
+    assert all(type(f.path) is Path for f in files)
+
+def test_get_files_and_folders_uses_scandir_entries(tmpdir, monkeypatch):
+    if fs.scandir is None:
+        return
+    p = create_fake_fs(Path(str(tmpdir)))
+    def fail(path):
+        raise AssertionError("%s wasn't supposed to be stat()'ed" % path)
+    for methodname in ['isdir', 'isfile', 'islink']:
+        monkeypatch.setattr(Path, methodname, fail)
+    files, folder_paths = fs.get_files_and_folders(p)
+    eq_((len(files), len(folder_paths)), (3, 3))
+
+def test_get_files_and_folders_reads_stats(tmpdir, monkeypatch):
+    p = create_fake_fs(Path(str(tmpdir)))
+    stats = p['file3.test'].stat()
+    if fs.scandir is not None:
+        # The stats come from the directory entries
+        monkeypatch.setattr(Path, 'stat', lambda path: 1/0)
+    files, folder_paths = fs.get_files_and_folders(p, read_stats=True)
+    f = first(f for f in files if f.path == p['file3.test'])
+    eq_((f.size, f.mtime), (3, stats.st_mtime))
+
+def test_get_files_and_folders_size_threshold(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    files, folder_paths = fs.get_files_and_folders(p, size_threshold=2)
+    eq_(sorted(f.path for f in files), [p['file2.test'], p['file3.test']])
+    eq_(len(folder_paths), 3)
+
+def test_dev_and_inode(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    f = fs.File(p['file1.test'])
+    stats = p['file1.test'].stat()
+    eq_((f.dev, f.inode), (stats.st_dev, stats.st_ino))
+
+@mark.skipif("not hasattr(hashlib, 'blake2b')")
+def test_hash_algorithm(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    f = fs.File(p['file1.test'])
+    eq_(f.hash_algorithm, 'md5')
+    f.hash_algorithm = 'blake2b'
+    eq_(f.md5, hashlib.blake2b(p['file1.test'].open('rb').read(), digest_size=16).digest())
+
+@mark.skipif("not hasattr(hashlib, 'blake2b')")
+def test_folder_hashes_subfiles_with_its_algorithm(tmpdir):
+    p = create_fake_fs(Path(str(tmpdir)))
+    b = fs.Folder(p['dir1'])
+    b.hash_algorithm = 'blake2b'
+    f = fs.File(p['dir1']['file1.test'])
+    f.hash_algorithm = 'blake2b'
+    eq_(b.md5, hashlib.blake2b(f.md5, digest_size=16).digest())
+
 def test_has_file_attrs(tmpdir):
     #a Folder must behave like a file, so it must have mtime attributes
     b = fs.Folder(Path(str(tmpdir)))
@@ -6,11 +6,13 @@
 # which should be included with this package. The terms are also available at 
 # http://www.gnu.org/licenses/gpl-3.0.html
 
+import hashlib
 import io
 import os.path as op
 
 from xml.etree import ElementTree as ET
 
+from pytest import mark
 from hscommon.testutil import eq_
 from hscommon.util import first
 
@@ -653,6 +655,23 @@ class TestCaseResultsXML:
         match = group.get_match_of(d3) #d2 - d3
         eq_(46, match[2])
     
+    @mark.skipif("not hasattr(hashlib, 'blake2b')")
+    def test_remember_hash_algorithm(self):
+        # Files remember the algorithm that was used to hash them. MD5, the default, isn't written.
+        self.objects[0].hash_algorithm = 'blake2b'
+        self.objects[1].hash_algorithm = 'md5'
+        f = io.BytesIO()
+        self.results.save_to_xml(f)
+        f.seek(0)
+        file_elems = list(ET.parse(f).getroot().iter('file'))
+        eq_([e.get('hash_algorithm') for e in file_elems[:2]], ['blake2b', None])
+        for o in self.objects:
+            o.hash_algorithm = 'md5'
+        f.seek(0)
+        self.results.load_from_xml(f, self.get_file)
+        eq_(self.objects[0].hash_algorithm, 'blake2b')
+        eq_(self.objects[1].hash_algorithm, 'md5')
+
     def test_save_and_load(self):
         # previously, when reloading matches, they wouldn't be reloaded as namedtuples
         f = io.BytesIO()
@@ -6,6 +6,9 @@
 # which should be included with this package. The terms are also available at
 # http://www.gnu.org/licenses/gpl-3.0.html
 
+import hashlib
+
+from pytest import mark
 from hscommon.jobprogress import job
 from hscommon.path import Path
 from hscommon.testutil import eq_
@@ -23,8 +26,12 @@ class NamedObject:
             path = Path(path)[name]
         self.name = name
         self.size = size
+        self.dev = self.inode = 0
         self.path = path
         self.words = getwords(name)
+        self.md5head = b''
+        self.md5samples = b''
+        self.size_signature = b''
 
     def __repr__(self):
         return '<NamedObject %r %r>' % (self.name, self.path)
@@ -50,6 +57,10 @@ def test_default_settings(fake_fileexists):
     eq_(s.mix_file_kind, True)
     eq_(s.word_weighting, False)
     eq_(s.match_similar_words, False)
+    eq_(s.approximate_matching, False)
+    eq_(s.bytewise_comparison, False)
+    eq_(s.hash_algorithm, 'md5')
+    eq_(s.hash_thread_count, 4)
     assert isinstance(s.ignore_list, IgnoreList)
 
 def test_simple_with_default_settings(fake_fileexists):
@@ -108,6 +119,28 @@ def test_content_scan(fake_fileexists):
     eq_(len(r[0]), 2)
     eq_(s.discarded_file_count, 0) # don't count the different md5 as discarded!
 
+@mark.skipif("not hasattr(hashlib, 'blake2b')")
+def test_content_scan_hash_algorithm(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    s.hash_algorithm = 'blake2b'
+    f = [no('foo'), no('bar')]
+    f[0].md5 = f[0].md5partial = 'foobar'
+    f[1].md5 = f[1].md5partial = 'foobar'
+    eq_(len(s.get_dupe_groups(f)), 1)
+    eq_([o.hash_algorithm for o in f], ['blake2b', 'blake2b'])
+
+def test_content_scan_unavailable_hash_algorithm(fake_fileexists):
+    # We fall back to the default algorithm rather than ending up with empty digests.
+    s = Scanner()
+    s.scan_type = ScanType.Contents
+    s.hash_algorithm = 'doesnt_exist'
+    f = [no('foo'), no('bar')]
+    f[0].md5 = f[0].md5partial = 'foobar'
+    f[1].md5 = f[1].md5partial = 'foobar'
+    s.get_dupe_groups(f)
+    eq_([o.hash_algorithm for o in f], ['md5', 'md5'])
+
 def test_content_scan_compare_sizes_first(fake_fileexists):
     class MyFile(no):
         @property
@@ -189,6 +222,22 @@ def test_similar_words(fake_fileexists):
     r = s.get_dupe_groups(f)
     eq_(len(r), 2)
 
+def test_approximate_matching(fake_fileexists):
+    s = Scanner()
+    s.approximate_matching = True
+    f = [no('foo bar baz', path='p1'), no('foo bar baz', path='p2'), no('bar baz foo'), no('foo bleh')]
+    r = s.get_dupe_groups(f)
+    eq_(len(r), 1)
+    eq_(len(r[0]), 3)
+
+def test_approximate_matching_fields(fake_fileexists):
+    s = Scanner()
+    s.approximate_matching = True
+    s.scan_type = ScanType.FieldsNoOrder
+    f = [no('The White Stripes - Little Ghost'), no('Little Ghost - The White Stripes')]
+    r = s.get_dupe_groups(f)
+    eq_(len(r), 1)
+
 def test_fields(fake_fileexists):
     s = Scanner()
     s.scan_type = ScanType.Fields
@@ -358,6 +407,21 @@ def test_ignore_list(fake_fileexists):
     # Ignored matches are not counted as discarded
     eq_(s.discarded_file_count, 0)
 
+def test_matches_are_consumed_as_a_stream(fake_fileexists):
+    # _getmatches() returns an iterator, which goes through all filters once.
+    s = Scanner()
+    f = [no('foo bar', path='p1'), no('foo bar', path='p2'), no('foo bar', path='p3')]
+    consumed = []
+    def getmatches(files, j):
+        for first, second in [(f[0], f[1]), (f[0], f[2]), (f[1], f[2])]:
+            consumed.append((first, second))
+            yield Match(first, second, 100)
+    s._getmatches = getmatches
+    r = s.get_dupe_groups(f)
+    eq_(len(consumed), 3)
+    eq_(len(r), 1)
+    eq_(len(r[0]), 3)
+
 def test_ignore_list_checks_for_unicode(fake_fileexists):
     #scanner was calling path_str for ignore list checks. Since the Path changes, it must
     #be unicode(path)
@@ -503,6 +567,13 @@ def test_folder_scan_exclude_subfolder_matches(fake_fileexists):
     otherf.path = Path('/otherfolder')
     eq_(len(s.get_dupe_groups([topf1, topf2, subf1, subf2, otherf])), 2)
 
+def test_folder_scan_compares_size_signatures_first(fake_fileexists):
+    s = Scanner()
+    s.scan_type = ScanType.Folders
+    f1, f2 = no("folder 1", size=42), no("folder 2", size=42)
+    f1.size_signature, f2.size_signature = b'foo', b'bar'
+    eq_(s.get_dupe_groups([f1, f2]), []) # no md5 attribute read
+
 def test_ignore_files_with_same_path(fake_fileexists):
     # It's possible that the scanner is fed with two file instances pointing to the same path. One
     # of these files has to be ignored
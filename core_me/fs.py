@@ -86,6 +86,10 @@ class MusicFile(fs.File):
         f = auto.File(str(self.path))
         return (f.audio_offset, f.audio_size)
 
+    def _get_md5head_offset_and_size(self):
+        f = auto.File(str(self.path))
+        return (f.audio_offset, min(f.audio_size, 0x1000))
+
     def _read_info(self, field):
         fs.File._read_info(self, field)
         if field in TAG_FIELDS: